@@ -7,20 +7,30 @@ import plotly.express as px
 import time 
 
 from dash import Dash, html, dcc, callback, Input, Output, State, dash_table, ctx, no_update, callback_context
+from dash import DiskcacheManager
 from dash.dash_table import DataTable
 from dash import jupyter_dash
 from dash.exceptions import PreventUpdate
-from sklearn.preprocessing import StandardScaler
+from flask import abort, jsonify, request
 from sklearn.decomposition import PCA
-from sklearn.model_selection import cross_val_score   
+from sklearn.model_selection import StratifiedKFold
+from sklearn.base import clone
+import diskcache
 
-from flask_caching import Cache
+import pyarrow.parquet as pq
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from uuid import uuid4
 import dash_bootstrap_components as dbc
 import platform
 import math
-import base64
-import io
+import hashlib
+import bisect
+import json
+import os
+import re
+import threading
+import warnings
 
 import dash_bootstrap_components as dbc
 from dash import dcc, html
@@ -33,22 +43,568 @@ from plotly.subplots import make_subplots
 
 
 # ---- Helpers to store/fetch heavy DataFrames ----
+def content_hash(*parts):
+    """Short, stable digest of upload contents and stage parameters."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if part is None:
+            part = b''
+        elif isinstance(part, str):
+            part = part.encode('utf-8')
+        elif not isinstance(part, (bytes, bytearray)):
+            part = repr(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\x00')  # separator so ('ab', 'c') != ('a', 'bc')
+    return digest.hexdigest()[:20]
+
+
+def make_stage_key(session_id, stage, *parts):
+    """
+    Stage keys look like '<scope>:<stage>:<hash>'. The hash of the inputs/parameters lets
+    identical work hit the cache. Stages that only depend on uploaded content (the loaded
+    files and the pipeline stages) are immutable and use the 'shared' scope (session_id
+    None), so identical uploads share one copy; per-session stages use the session id.
+    """
+    return f"{session_id or 'shared'}:{stage}:{content_hash(*parts)}"
+
+
+# Tables (CANOPUS, metadata) are zstd-compressed Parquet files: columnar, so a callback
+# can read a handful of columns or rows without loading the whole table.
+# Peak-area matrices use matrix_put / matrix_get below.
+STAGE_DIR = os.path.join("dash_cache", "stages")
+STAGE_FORMAT = 2  # part of the upload fingerprint: bump when the stage files change layout
+
+
+def stage_path(stage_key, ext=".parquet"):
+    # ':' separates the key parts but is not allowed in Windows file names
+    return os.path.join(STAGE_DIR, stage_key.replace(':', '_') + ext)
+
+
+def touch_stage(stage_key, ext=".parquet"):
+    """Mark a stage as used now: sweep_stages evicts the least recently used stages first."""
+    try:
+        os.utime(stage_path(stage_key, ext))
+    except OSError:  # swept meanwhile
+        pass
+
+
 def cache_put(df, stage_key):
-    """Stage key is a short name like 'raw', 'blanked', etc."""
+    """Stage key comes from make_stage_key, e.g. 'shared:canopus:<hash>'."""
     # Optionally downcast here if you want one centralized place
     # df = downcast_numeric(df)
-    cache.set(stage_key, df)
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    path = stage_path(stage_key)
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+    os.replace(tmp_path, path)  # atomic: concurrent readers never see half a file
     return stage_key
 
-def cache_get(stage_key):
-    if not stage_key:
+def cache_get(stage_key, columns=None, rows=None):
+    """
+    Read a stage back. The first column (sample/compound label) is always returned;
+    `columns` restricts the remaining columns and `rows` keeps only the rows whose
+    label is listed. Both are pushed down to the Parquet reader.
+    """
+    if not stage_key or not os.path.exists(stage_path(stage_key)):
+        return None
+    path = stage_path(stage_key)
+    schema = pq.read_schema(path)
+    label_col = schema.names[0]
+    if columns is not None:
+        columns = [label_col] + [col for col in columns if col != label_col]
+    if rows is not None and len(rows) == 0:
+        # Arrow cannot type an empty 'in' set; nothing to read anyway
+        return schema.empty_table().to_pandas()[columns or schema.names]
+    filters = [(label_col, 'in', list(rows))] if rows is not None else None
+    touch_stage(stage_key)
+    return pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters)
+
+def cache_columns(stage_key):
+    """Column names of a stage, read from the file footer only."""
+    if not stage_key or not os.path.exists(stage_path(stage_key)):
+        return []
+    return pq.read_schema(stage_path(stage_key)).names
+
+def cache_has(stage_key):
+    return bool(stage_key) and os.path.exists(stage_path(stage_key))
+
+
+def annotations_put(ft_sirius, stage_key, node_colors):
+    """Annotation table stage plus the node colors computed for it at ingest."""
+    path = stage_path(stage_key, ".colors.json")
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(node_colors, fh)
+    os.replace(tmp_path, path)
+    return cache_put(ft_sirius, stage_key)
+
+def annotations_get(stage_key, columns=None):
+    """(annotation table, node color map) of a stage, or (None, None)."""
+    ft_sirius = cache_get(stage_key, columns=columns)
+    if ft_sirius is None:
+        return None, None
+    with open(stage_path(stage_key, ".colors.json")) as fh:
+        return ft_sirius, json.load(fh)
+
+
+# ---- Peak-area stages as memory-mapped float32 matrices ----
+# raw/blanked/imputed/normalized/scaled are samples x features float32 arrays in
+# an .npy file plus two JSON sidecars with the sample labels and the feature ids
+# (see the feature registry below). Readers
+# np.load them with mmap_mode='r', so every worker process shares the same pages
+# from the OS page cache instead of holding its own unpickled copy.
+StageMatrix = namedtuple("StageMatrix", ["values", "samples", "features", "label"])
+
+
+def matrix_put(df, stage_key):
+    """`df` has the sample label as first column and one numeric column per feature."""
+    label_col = df.columns[0]
+    return matrix_save(stage_key, df.iloc[:, 1:].to_numpy(dtype=np.float32),
+                       df[label_col].astype(str).tolist(), df.columns[1:], label_col)
+
+def matrix_save(stage_key, values, samples, features, label='filename'):
+    """Write a samples x features array (plus its labels) as a stage."""
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    # Fortran order keeps each feature's samples contiguous, so reading a subset
+    # of features only touches the pages of those features
+    values = np.asfortranarray(values, dtype=np.float32)
+    index = {
+        "samples": json.dumps({"label": str(label), "labels": [str(sample) for sample in samples]}),
+        "features": json.dumps({"labels": [int(feature) if isinstance(feature, (int, np.integer)) else str(feature)
+                                           for feature in features]}),
+    }
+    for part, text in index.items():
+        path = stage_path(stage_key, f".{part}.json")
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(text)
+        os.replace(tmp_path, path)
+    # The matrix goes last: once it exists, its sidecars are complete
+    path = stage_path(stage_key, ".f32.npy")
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.save(fh, values)
+    os.replace(tmp_path, path)
+    return stage_key
+
+def matrix_get(stage_key):
+    """Memory-mapped, read-only StageMatrix, or None if the stage does not exist."""
+    if not matrix_has(stage_key):
+        return None
+    with open(stage_path(stage_key, ".samples.json")) as fh:
+        samples = json.load(fh)
+    with open(stage_path(stage_key, ".features.json")) as fh:
+        features = json.load(fh)
+    values = np.load(stage_path(stage_key, ".f32.npy"), mmap_mode="r")
+    touch_stage(stage_key, ".f32.npy")
+    return StageMatrix(values, samples["labels"], features["labels"], samples["label"])
+
+def matrix_has(stage_key):
+    return bool(stage_key) and os.path.exists(stage_path(stage_key, ".f32.npy"))
+
+def matrix_delete(stage_key):
+    # Matrix first: a stage without its matrix no longer exists for matrix_has
+    for ext in (".f32.npy", ".samples.json", ".features.json"):
+        try:
+            os.remove(stage_path(stage_key, ext))
+        except OSError:  # already gone (or still mapped, on Windows)
+            pass
+
+def matrix_frame(matrix, rows=None, columns=None):
+    """
+    DataFrame view (samples as index) of a StageMatrix. Without `rows`/`columns`
+    the frame wraps the memory map itself; with them only the selected samples
+    and features are copied out.
+    """
+    values = matrix.values
+    samples = pd.Index(matrix.samples, name=matrix.label)
+    features = pd.Index(matrix.features)
+    if rows is not None:
+        row_pos = samples.get_indexer(pd.Index(rows).unique())
+        row_pos = np.sort(row_pos[row_pos >= 0])
+        if len(row_pos) < len(samples):
+            values, samples = values[row_pos], samples[row_pos]
+    if columns is not None:
+        col_pos = features.get_indexer(pd.Index(columns).unique())
+        col_pos = np.sort(col_pos[col_pos >= 0])
+        if len(col_pos) < len(features):
+            values, features = values[:, col_pos], features[col_pos]
+    return pd.DataFrame(values, index=samples, columns=features, copy=False)
+
+
+# ---- Stage eviction ----
+# Stage files are never rewritten, so they pile up: every upload, parameter and sample
+# grouping adds some. sweep_stages runs when files are loaded and when the pipeline
+# runs; it deletes the stages unused for STAGE_TTL, then the least recently used ones
+# until STAGE_DIR fits in STAGE_MAX_BYTES. A stage's last use is the newest modification
+# time of its files, refreshed by every read (see touch_stage). A session whose stage was
+# swept finds it missing, like any stage that was never computed.
+STAGE_TTL = int(os.environ.get("CANVAS_STAGE_TTL", 7 * 24 * 3600))  # seconds
+STAGE_MAX_BYTES = int(os.environ.get("CANVAS_STAGE_MAX_BYTES", 20 * 1024 ** 3))
+# Files of one stage; the data file comes first, so a stage being deleted stops
+# existing (matrix_has / cache_has) before its sidecars go
+STAGE_SUFFIXES = (".f32.npy", ".parquet", ".samples.json", ".features.json", ".colors.json")
+
+
+def sweep_stages():
+    """Delete stages unused for STAGE_TTL, then the oldest ones beyond STAGE_MAX_BYTES."""
+    cutoff = time.time() - STAGE_TTL
+    stages = {}  # file name without suffix -> [last use, bytes, [(suffix rank, path)]]
+    for entry in os.scandir(STAGE_DIR):
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".tmp"):
+                # Left behind by a killed job; a write in progress is far younger
+                if stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                continue
+        except OSError:  # removed meanwhile by another worker
+            continue
+        rank = next((i for i, suffix in enumerate(STAGE_SUFFIXES) if entry.name.endswith(suffix)), None)
+        if rank is None:
+            continue
+        stage = stages.setdefault(entry.name[:-len(STAGE_SUFFIXES[rank])], [0.0, 0, []])
+        stage[0] = max(stage[0], stat.st_mtime)
+        stage[1] += stat.st_size
+        stage[2].append((rank, entry.path))
+
+    total = sum(size for _, size, _ in stages.values())
+    for last_use, size, files in sorted(stages.values(), key=lambda stage: stage[0]):
+        if last_use >= cutoff and total <= STAGE_MAX_BYTES:
+            break
+        for _, path in sorted(files):
+            try:
+                os.remove(path)
+            except OSError:  # already gone (or still mapped, on Windows)
+                pass
+        total -= size
+
+
+# ---- Feature registry ----
+# Features are keyed by an integer id, their column in the raw matrix. The annotation
+# table holds one row per id, in id order, so matrices and annotations are joined by
+# position. The "X<alignment id>_<m/z>_<RT>_<name>[;<pubchem>]" label that used to be
+# the key is only built for display, by feature_labels.
+FEATURE_FIELDS = ['feature_id', 'alignment_id', 'mz', 'rt', 'name', 'pubchem']
+
+
+def feature_registry(alignment_ids, mz, rt, names, pubchem):
+    """Registry columns for features 0..n-1; `pubchem` is missing when it equals the name."""
+    names = pd.Series(names, dtype=object).reset_index(drop=True)
+    pubchem = pd.Series(pubchem, dtype=object).reset_index(drop=True)
+    return pd.DataFrame({
+        'feature_id': np.arange(len(names), dtype=np.int32),
+        'alignment_id': np.asarray(alignment_ids, dtype=np.int64),
+        'mz': np.asarray(mz, dtype=np.float64),
+        'rt': np.asarray(rt, dtype=np.float64),
+        'name': names.astype(str),
+        'pubchem': pubchem.astype(str).where(names != pubchem, None),
+    })
+
+
+def feature_labels(ft_sirius):
+    """Display labels "X<alignment id>_<m/z>_<RT>_<name>[;<pubchem>]" of registry rows."""
+    combined = ft_sirius['name'].astype(str)
+    combined = combined.where(ft_sirius['pubchem'].isna(), combined + ';' + ft_sirius['pubchem'].astype(str))
+    return (
+        'X' + ft_sirius['alignment_id'].astype(str)
+        + '_' + ft_sirius['mz'].astype(np.float64).round(3).astype(str)
+        + '_' + ft_sirius['rt'].astype(np.float64).round(3).astype(str)
+        + '_' + combined
+    )
+
+
+def stage_feature_labels(canopus_key, feature_ids):
+    """Display labels of `feature_ids`, reading only the registry columns of the annotation stage."""
+    feature_ids = [int(feature_id) for feature_id in feature_ids]
+    registry = cache_get(canopus_key, columns=FEATURE_FIELDS, rows=feature_ids)
+    registry = registry.set_index('feature_id').reindex(feature_ids).reset_index()
+    return feature_labels(registry).tolist()
+
+
+# Compound selection: selected names are resolved to feature ids once per request.
+# The name index joins the distinct names and PubChem ids into one string, so each
+# selected name costs a few str.find calls (partial match) instead of a scan of every
+# feature; each entry points to the ids of the features carrying it.
+FeatureNameIndex = namedtuple("FeatureNameIndex", ["text", "starts", "entry_ptr", "feature_ids"])
+
+
+def build_name_index(ft_sirius):
+    """FeatureNameIndex over the 'name' and 'pubchem' registry fields of `ft_sirius`."""
+    entries = pd.concat([ft_sirius['name'], ft_sirius['pubchem']]).astype(object)
+    ids = np.concatenate([ft_sirius['feature_id'].to_numpy()] * 2)
+    present = entries.notna().to_numpy()
+    codes, uniques = pd.factorize(entries[present].astype(str))
+    order = np.argsort(codes, kind='stable')
+    entry_ptr = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+
+    # '\x00' separates the entries, so a match never spans two of them
+    lengths = np.array([len(entry) + 1 for entry in uniques], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+    text = ''.join(f"{entry}\x00" for entry in uniques)
+    return FeatureNameIndex(text, starts, entry_ptr, ids[present][order])
+
+
+# In-process LRUs of the search indexes, keyed by the stage keys they are built from
+# (content hashes, so an entry is never stale; a worker that misses rebuilds it).
+# One LRU per kind of index (the first part of the key), so that, e.g., many
+# selections never push the name or m/z - RT indexes out.
+INDEX_CACHE_SIZE = 16  # entries per kind, unless listed below
+INDEX_CACHE_SIZES = {
+    'names': 8,         # per annotation stage
+    'search': 8,        # per (stage, annotation stage)
+    'mz-rt': 8,         # per annotation stage
+    'metadata': 8,      # per metadata stage
+    'annotations': 8,   # per annotation stage
+    'group-order': 16,  # per group table set
+    'selection': 16,    # per store-selection value
+}
+_indexes = {}  # kind -> OrderedDict
+_indexes_lock = threading.Lock()
+
+
+def cached_index(key, build):
+    kind = key[0]
+    with _indexes_lock:
+        entries = _indexes.setdefault(kind, OrderedDict())
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+    index = build()
+    with _indexes_lock:
+        entries[key] = index
+        while len(entries) > INDEX_CACHE_SIZES.get(kind, INDEX_CACHE_SIZE):
+            entries.popitem(last=False)
+    return index
+
+
+def feature_name_index(canopus_key, ft_sirius=None):
+    """Name index of an annotation stage, built on first use."""
+    def build():
+        table = ft_sirius if ft_sirius is not None else cache_get(canopus_key, columns=['name', 'pubchem'])
+        return build_name_index(table)
+    return cached_index(('names', canopus_key), build)
+
+
+def resolve_selection(index, selected_compounds):
+    """
+    Sorted ids of the features whose name or PubChem id contains one of
+    `selected_compounds` (partial match), or None when nothing is selected.
+    """
+    if not selected_compounds:
         return None
-    return cache.get(stage_key)
+    entries = set()
+    for selected in selected_compounds:
+        pos = index.text.find(selected)
+        while 0 <= pos < len(index.text):
+            entry = int(np.searchsorted(index.starts, pos, side='right')) - 1
+            entries.add(entry)
+            pos = index.text.find(selected, index.starts[entry + 1])  # next entry
+    if not entries:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate([
+        index.feature_ids[index.entry_ptr[entry]:index.entry_ptr[entry + 1]] for entry in entries
+    ]))
+
+
+# Compound browser: ranked search over the name, PubChem id and m/z of the features
+# of a stage. Search keys are case-folded and kept sorted (exact and prefix matches
+# are a bisect), with a trigram -> keys map for substring and fuzzy matches; each key
+# points to the features (CSR) it was taken from.
+CompoundSearchIndex = namedtuple("CompoundSearchIndex", ["keys", "key_labels", "key_ptr", "key_names",
+                                                         "trigrams", "gram_ptr", "gram_keys", "names"])
+SEARCH_FUZZY_OVERLAP = 0.5  # share of the query trigrams a fuzzy match must contain
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build_search_index(ft_sirius):
+    """CompoundSearchIndex over the registry rows of `ft_sirius` (one per feature)."""
+    name_codes, names = pd.factorize(ft_sirius['name'].astype(str))
+    fields = [
+        ft_sirius['name'].astype(str),
+        ft_sirius['pubchem'],
+        ft_sirius['mz'].astype(np.float64).round(4).astype(str),
+    ]
+    entries = pd.concat(fields, ignore_index=True)
+    entry_names = np.tile(name_codes, len(fields))
+    present = entries.notna().to_numpy()
+    entries = entries[present].astype(str)
+
+    # Key -> names of its features, each name once
+    codes, keys = pd.factorize(entries.str.casefold(), sort=True)
+    key_labels = entries.iloc[np.unique(codes, return_index=True)[1]].tolist()  # as written
+    pairs = np.unique(codes.astype(np.int64) * len(names) + entry_names[present])
+    key_ptr = np.searchsorted(pairs // len(names), np.arange(len(keys) + 1))
+    keys = keys.tolist()
+
+    # Trigram -> keys containing it, each key once
+    n_grams = np.array([max(len(key) - 2, 0) for key in keys], dtype=np.int64)
+    gram_codes, grams = pd.factorize(pd.Series(
+        [key[i:i + 3] for key in keys for i in range(len(key) - 2)], dtype=object))
+    gram_pairs = np.unique(gram_codes.astype(np.int64) * len(keys)
+                           + np.repeat(np.arange(len(keys)), n_grams))
+    gram_ptr = np.searchsorted(gram_pairs // len(keys), np.arange(len(grams) + 1))
+    return CompoundSearchIndex(
+        keys, key_labels, key_ptr, (pairs % len(names)).astype(np.int32),
+        {gram: i for i, gram in enumerate(grams)}, gram_ptr,
+        (gram_pairs % len(keys)).astype(np.int32), names.tolist(),
+    )
+
+
+def search_compounds(index, query, limit=20):
+    """
+    Names of the features matching `query` (case-insensitive) on their name, PubChem id
+    or m/z, best first: exact matches, then prefix matches, then substring matches,
+    then fuzzy (trigram overlap) matches. Returns (name, matched key) pairs.
+    """
+    query = (query or '').strip().casefold()
+    if not query:
+        return []
+    keys = index.keys
+    ranked = []  # key indices, best first
+
+    # Exact and prefix matches: a contiguous run of the sorted keys
+    lo = bisect.bisect_left(keys, query)
+    hi = lo
+    while hi < len(keys) and keys[hi].startswith(query) and hi - lo < limit * 10:
+        hi += 1
+    ranked.extend(range(lo, hi))  # keys[lo] == query (if present) sorts first
+
+    grams = trigrams(query)
+    if grams and len(ranked) < limit * 10:
+        codes = [index.trigrams[gram] for gram in grams if gram in index.trigrams]
+        hits = [index.gram_keys[index.gram_ptr[code]:index.gram_ptr[code + 1]] for code in codes]
+        if hits:
+            counts = np.bincount(np.concatenate(hits), minlength=len(keys))
+            seen = set(ranked)
+            # Substring: every trigram present, then checked against the key
+            full = np.flatnonzero(counts == len(grams))
+            ranked.extend(i for i in full if i not in seen and query in keys[i])
+            # Fuzzy: most shared trigrams first
+            needed = max(1, math.ceil(len(grams) * SEARCH_FUZZY_OVERLAP))
+            fuzzy = np.flatnonzero(counts >= needed)
+            fuzzy = fuzzy[np.argsort(-counts[fuzzy], kind='stable')]
+            seen.update(ranked)
+            ranked.extend(i for i in fuzzy if i not in seen)
+
+    results, seen_names = [], set()
+    for i in ranked:
+        for code in index.key_names[index.key_ptr[i]:index.key_ptr[i + 1]]:
+            if code not in seen_names:
+                seen_names.add(code)
+                results.append((index.names[code], index.key_labels[i]))
+        if len(results) >= limit:
+            break
+    return results[:limit]
+
+
+# m/z - RT lookup: the features sorted by m/z, so a "m/z +- ppm" window is two binary
+# searches; the RT range is then checked on the few features inside the window.
+MzRtIndex = namedtuple("MzRtIndex", ["mz", "rt", "feature_ids"])
+MZ_TOLERANCE_PPM = 5
+
+
+def build_mz_rt_index(ft_sirius):
+    """MzRtIndex over the 'mz' / 'rt' registry fields of `ft_sirius`."""
+    mz = ft_sirius['mz'].to_numpy(dtype=np.float64)
+    order = np.argsort(mz, kind='stable')
+    return MzRtIndex(mz[order], ft_sirius['rt'].to_numpy(dtype=np.float64)[order],
+                     ft_sirius['feature_id'].to_numpy()[order])
+
+
+def mz_rt_index(canopus_key, ft_sirius=None):
+    """m/z - RT index of an annotation stage, built on first use."""
+    def build():
+        table = ft_sirius if ft_sirius is not None else cache_get(canopus_key, columns=['mz', 'rt'])
+        return build_mz_rt_index(table)
+    return cached_index(('mz-rt', canopus_key), build)
+
+
+def match_mz_rt(index, targets, ppm=MZ_TOLERANCE_PPM, rt_min=None, rt_max=None):
+    """
+    Features within `ppm` of each target m/z (and rt_min <= RT <= rt_max, if given;
+    scalars or one value per target). Batch lookup: one pair of binary searches per
+    target, all vectorized.
+
+    Returns a DataFrame with one row per (target, feature) match: target (position in
+    `targets`), target_mz, feature_id, mz, rt and ppm_error.
+    """
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    tolerance = targets * ppm * 1e-6
+    starts = np.searchsorted(index.mz, targets - tolerance, side='left')
+    stops = np.searchsorted(index.mz, targets + tolerance, side='right')
+
+    # Expand every [start, stop) window into the positions it holds
+    counts = stops - starts
+    target = np.repeat(np.arange(len(targets)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+    keep = np.ones(len(positions), dtype=bool)
+    rt = index.rt[positions]
+    if rt_min is not None:
+        keep &= rt >= np.broadcast_to(np.asarray(rt_min, dtype=np.float64), targets.shape)[target]
+    if rt_max is not None:
+        keep &= rt <= np.broadcast_to(np.asarray(rt_max, dtype=np.float64), targets.shape)[target]
+    target, positions = target[keep], positions[keep]
+
+    mz = index.mz[positions]
+    return pd.DataFrame({
+        'target': target,
+        'target_mz': targets[target],
+        'feature_id': index.feature_ids[positions],
+        'mz': mz,
+        'rt': index.rt[positions],
+        'ppm_error': (mz - targets[target]) / targets[target] * 1e6,
+    })
+
+
+def query_mz_rt(index, mz=None, ppm=MZ_TOLERANCE_PPM, rt_min=None, rt_max=None):
+    """Sorted ids of the features within `ppm` of `mz` (any m/z if None) and inside the RT range."""
+    if mz is not None:
+        return np.sort(match_mz_rt(index, mz, ppm, rt_min, rt_max)['feature_id'].to_numpy())
+    keep = np.ones(len(index.rt), dtype=bool)
+    if rt_min is not None:
+        keep &= index.rt >= rt_min
+    if rt_max is not None:
+        keep &= index.rt <= rt_max
+    return np.sort(index.feature_ids[keep])
+
+
+def register_features(peak_areas, annotations):
+    """
+    Key already processed uploads by feature id: `peak_areas` has the samples on rows
+    and one "X..." labelled column per feature, `annotations` the same labels in its
+    first column. Returns the matrix with integer columns and the annotation table
+    (registry fields first) in matrix order.
+    """
+    labels = pd.Series(peak_areas.columns[1:], dtype=str)
+    parts = labels.str.split('_', n=3, expand=True).reindex(columns=range(4))
+
+    # Labels must read X<id>_<m/z>_<RT>_<name> (see feature_labels): report the ones that do not
+    ids = pd.to_numeric(parts[0].str[1:].where(parts[0].str[0] == 'X'), errors='coerce')
+    mzs = pd.to_numeric(parts[1], errors='coerce')
+    rts = pd.to_numeric(parts[2], errors='coerce')
+    bad = ids.isna() | (ids % 1 != 0) | mzs.isna() | rts.isna() | parts[3].isna()
+    if bad.any():
+        shown = ", ".join(labels[bad].head(5))
+        more = f" and {int(bad.sum()) - 5} more" if bad.sum() > 5 else ""
+        raise ValueError(f"Feature columns not labelled X<id>_<m/z>_<RT>_<name>: {shown}{more}.")
+
+    combined = parts[3].str.rsplit(';', n=1, expand=True).reindex(columns=range(2))
+    registry = feature_registry(ids.astype(np.int64), mzs, rts, combined[0], combined[1].fillna(combined[0]))
+    annotations = annotations.set_index(annotations.columns[0]).reindex(labels.values)
+    annotations = pd.concat([registry, annotations.reset_index(drop=True)], axis=1)
+
+    peak_areas = peak_areas.copy()
+    peak_areas.columns = [peak_areas.columns[0]] + registry['feature_id'].tolist()
+    return peak_areas, annotations
 
 
 def processing_raw_files(peak_areas,metadata,canopus,structure,pattern):
     ft = peak_areas
-    md = metadata
     an_gnps = structure
     sirius = canopus
 
@@ -56,70 +612,36 @@ def processing_raw_files(peak_areas,metadata,canopus,structure,pattern):
         return None, None, None, None 
 
 
-# Merge 'an_analog' with 'an_gnps' using a full join on the '#Scan#' column
-    an_final = an_gnps
+    # Full join of the structure and CANOPUS annotations on 'mappingFeatureId',
+    # keeping the first annotation of each feature, indexed by feature id
     an_final = pd.merge(an_gnps, sirius, on='mappingFeatureId', how='outer')
-# Consolidate multiple annotations for a single '#Scan#' into one combined name
+    an_final = an_final.drop_duplicates('mappingFeatureId').set_index('mappingFeatureId')
 
-
-    an_final_single = an_final.groupby("mappingFeatureId").apply(lambda group: pd.Series({
-        'Combined_Name': combine_names(group.iloc[0])
-    })).reset_index()
-
-# To get the DataFrame with that exact column name (without automatic renaming)
-    an_final_single.columns = an_final_single.columns.str.replace('.', '_')
-
-    ft_an1 = ft.merge(an_final, left_on= "Alignment ID",  how='inner', right_on= "mappingFeatureId", sort=True)
-
-    ft_an = ft_an1.merge(an_final_single, left_on= "mappingFeatureId",  how='inner', right_on= "mappingFeatureId", sort=True)
-    an_final = an_final.rename(columns={'Alignment ID':'mappingFeatureId'})
-    # Merge 'an_final' with 'sirius' on 'row ID'
-    merged_data = pd.merge(an_final, sirius, on='mappingFeatureId', how='outer')
-
-    new_md = md.copy() #storing the files under different names to preserve the original files
-    new_ft2 = ft.copy()
-    
-    # Perform the inner join to get the matching rows
-    matching_rows = new_ft2.merge(an_final_single, left_on="Alignment ID", right_on="mappingFeatureId", how='inner')
-    
-    # Filter the original DataFrame to keep only the matching rows
-    new_ft = ft[ft["Alignment ID"].isin(matching_rows["Alignment ID"])]
-
-    #new_ft.columns = new_ft.columns.str.replace(' Peak area', '') # Removing " Peak area" extensions from the column names of new_ft
+    # Keep annotated features, ordered by "Alignment ID", and align the annotations
+    # to them by index instead of merging the full tables
+    new_ft = ft[ft["Alignment ID"].isin(an_final.index)]
     new_ft = new_ft.sort_values(by='Alignment ID') # Arranging the rows of new_ft by ascending order of "row ID"
+    ft_an = an_final.reindex(new_ft["Alignment ID"].values)
     
-    new_ft = new_ft.loc[:, new_ft.notna().sum() > 0] # Removing columns in new_ft where all values are NaN
-    new_md = new_md.loc[:, new_md.notna().sum() > 0] # Removing columns in new_md where all values are NaN
-    
-    new_md = new_md[new_md.apply(lambda row: all(item != "" for item in row), axis=1)] # Remove rows where all the elements are empty strings
-    new_md = new_md.applymap(lambda x: x.strip() if isinstance(x, str) else x) # Remove leading and trailing spaces from each column of new_md
+    new_ft = new_ft.loc[:, new_ft.notna().any()] # Removing columns in new_ft where all values are NaN
 
-    # Changing the index (row names) of new_ft into the combined name as "XID_mz_RT":
-    new_name = 'X' + new_ft['Alignment ID'].astype(str) + '_' + new_ft['Average Mz'].round(3).astype(str) + '_' + new_ft['Average Rt(min)'].round(3).astype(str) 
-    new_name_values = new_name.values
-    
-    if 'ft_an' in locals():
-        combined_name_ft = ft_an['Combined_Name'].astype(str).values
-        underscore_added = ['_' + x for x in combined_name_ft] #add a underscore prefix
-        new_name_values = np.core.defchararray.add(new_name_values.astype(str), underscore_added)
-    
-    # Set the new index and remove trailing underscore if present
-    new_ft.index = new_name_values
-    ft_an.index = new_name_values
+    # Features are keyed by their position (feature id); the name/PubChem id that used
+    # to go into the "XID_mz_RT_name" row names goes into the registry instead
+    registry = feature_registry(new_ft['Alignment ID'], new_ft['Average Mz'], new_ft['Average Rt(min)'],
+                                ft_an['name'], ft_an['pubchemids'])
+    new_ft.index = registry['feature_id'].values
     
     # Selecting only the columns with names containing 'mzXML' or 'mzML'
     new_ft = new_ft.loc[:, new_ft.columns.str.contains(f'^{pattern}')]
     new_ft_sirius_NPC = ft_an.loc[:, ft_an.columns.str.contains('^NPC|^SiriusScoreNormalized')]
-    new_md = new_md.rename(columns={'name_file': 'filename'})
     new_ft = new_ft.reindex(columns=sorted(new_ft.columns)) # Ordering the columns of 'new_ft' by their names
-    new_md = new_md.sort_values(by='filename').reset_index(drop=True) #ordering the md by the 1st column filename
 
     #DATA CLEAN UP PART
-    ft_t = pd.DataFrame(new_ft).T
-    ft_t = ft_t.apply(pd.to_numeric) #converting all values to numeric
+    # Convert the (few) sample columns before transposing, not the (many) feature columns after
+    ft_t = new_ft.apply(pd.to_numeric).T
     
     ft_t = ft_t.reset_index()
-    new_ft_sirius_NPC = new_ft_sirius_NPC.reset_index()
+    new_ft_sirius_NPC = pd.concat([registry, new_ft_sirius_NPC.reset_index(drop=True)], axis=1)
     
     return ft_t,new_ft_sirius_NPC
    
@@ -128,10 +650,33 @@ def processing_raw_files(peak_areas,metadata,canopus,structure,pattern):
 # In[20]:
 
 
+def scale_features(values, out=None):
+    """
+    StandardScaler on a samples x features float array: zero mean, unit variance per feature.
+
+    Scales in place unless `out` is given. Statistics are accumulated in float64 and
+    NaNs are ignored (and kept), as StandardScaler does; constant features get scale 1.
+    """
+    if np.isnan(values).any():
+        mean = np.nanmean(values, axis=0, dtype=np.float64)
+        std = np.nanstd(values, axis=0, dtype=np.float64)
+    else:
+        mean = values.mean(axis=0, dtype=np.float64)
+        std = values.std(axis=0, dtype=np.float64)
+    std[std < 10 * np.finfo(np.float64).eps] = 1.0
+
+    if out is None:
+        out = values
+    np.subtract(values, mean, out=out, casting='same_kind')
+    np.divide(out, std, out=out, casting='same_kind')
+    return out
+
+
 def scaling(imp):
-    Imp_scaled = imp.copy()
-    Imp_scaled.set_index(Imp_scaled.columns[0], inplace=True)
-    Imp_scaled = pd.DataFrame(StandardScaler().fit_transform(Imp_scaled),
+    """DataFrame version of scale_features (first column = sample label)."""
+    Imp_scaled = imp.set_index(imp.columns[0])
+    values = Imp_scaled.to_numpy(dtype=np.float32, copy=True)
+    Imp_scaled = pd.DataFrame(scale_features(values),
                       index=Imp_scaled.index,
                       columns=Imp_scaled.columns)
     Imp_scaled.index.name = 'filename'
@@ -143,11 +688,19 @@ def scaling(imp):
 # In[21]:
 
 
+def normalize_rows(values):
+    """TIC normalization in place: divide each sample (row) by its row sum."""
+    values /= values.sum(axis=1, dtype=np.float64, keepdims=True)
+    return values
+
+
 def normalization(imp):
-    normalized = imp.copy()
-    normalized.set_index(normalized.columns[0], inplace=True)
-    # Dividing each element of a particular row (as each row is the sample) with its row sum
-    norm_TIC = normalized.apply(lambda x: x/np.sum(x), axis=1)
+    """DataFrame version of normalize_rows (first column = sample label)."""
+    normalized = imp.set_index(imp.columns[0])
+    values = normalized.to_numpy(dtype=np.float32, copy=True)
+    norm_TIC = pd.DataFrame(normalize_rows(values),
+                            index=normalized.index,
+                            columns=normalized.columns)
     norm_TIC.index.name = 'filename'
     norm_TIC.columns.name = 'compound_name'
     norm_TIC = norm_TIC.reset_index()
@@ -157,11 +710,97 @@ def normalization(imp):
 # In[22]:
 
 
-def imputation(blk_rem):
-    cutoff_LOD = round(blk_rem.replace(0, np.nan).min(numeric_only=True).min())
-    np.random.seed(141222)
+IMPUTATION_SEED = 141222
+IMPUTATION_CHUNK = 4096            # features per block (bounds the temporary arrays)
+IMPUTATION_KNN_CANDIDATES = 50     # nearest samples searched for donors of a feature
+IMPUTATION_STRATEGIES = {
+    'lod': 'Random below LOD',
+    'half_min': 'Half feature minimum',
+    'knn': 'KNN (5 nearest samples)',
+}
+
+
+def impute_matrix(values, strategy='lod', seed=IMPUTATION_SEED, n_neighbors=5):
+    """
+    Replace the zeros (undetected peaks) of a samples x features float array in place.
+
+    'lod'      : random integer in [1, LOD), LOD = smallest non-zero value of the matrix
+    'half_min' : half of the feature's smallest non-zero value
+    'knn'      : mean of the feature over the `n_neighbors` closest samples that detected it
+                 (nan-euclidean distance over the features both samples detected)
+
+    Random draws come from a local Generator seeded with `seed`, so results are
+    reproducible without touching the global NumPy random state.
+    """
+    if strategy == 'lod':
+        missing = values == 0
+        if missing.all():
+            raise ValueError("No detected values to derive a limit of detection from.")
+        cutoff_LOD = round(float(np.nanmin(np.where(missing, np.inf, values))))
+        if cutoff_LOD <= 1:
+            raise ValueError(f"Limit of detection {cutoff_LOD} is too small for random imputation.")
+        rng = np.random.default_rng(seed)
+        values[missing] = rng.integers(1, cutoff_LOD, size=int(missing.sum()))
+
+    elif strategy == 'half_min':
+        for start in range(0, values.shape[1], IMPUTATION_CHUNK):
+            block = values[:, start:start + IMPUTATION_CHUNK]  # view, written in place
+            missing = block == 0
+            feature_min = np.nanmin(np.where(missing, np.inf, block), axis=0)
+            feature_min[~np.isfinite(feature_min)] = 0  # never detected: stays 0
+            block[missing] = np.broadcast_to(feature_min / 2, block.shape)[missing]
+
+    elif strategy == 'knn':
+        missing = values == 0
+        n_samples, n_features = values.shape
+
+        # Sample x sample distances, accumulated over feature blocks
+        sq_dist = np.zeros((n_samples, n_samples))
+        n_common = np.zeros((n_samples, n_samples))
+        for start in range(0, n_features, IMPUTATION_CHUNK):
+            observed = ~missing[:, start:start + IMPUTATION_CHUNK]
+            block = values[:, start:start + IMPUTATION_CHUNK].astype(np.float64)
+            # sum over shared features of (x_i - x_j)^2 = sq_i.o_j + o_i.sq_j - 2 x_i.x_j
+            cross = (block * block) @ observed.T.astype(np.float64)
+            sq_dist += cross + cross.T - 2 * block @ block.T
+            n_common += observed.astype(np.float32) @ observed.T.astype(np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.sqrt(np.clip(sq_dist, 0, None) * n_features / n_common)
+        distances[n_common == 0] = np.inf
+        np.fill_diagonal(distances, np.inf)
+        n_candidates = min(IMPUTATION_KNN_CANDIDATES, n_samples - 1)
+        candidates = np.argsort(distances, axis=1)[:, :n_candidates]
+
+        # Fallback for features without a donor among the candidates: feature mean
+        detected = (~missing).sum(axis=0)
+        feature_mean = np.where(missing, 0, values).sum(axis=0) / np.maximum(detected, 1)
+
+        # Row-major copies: imputed cells must not serve as donors, and each
+        # sample's candidate rows are gathered as contiguous blocks
+        donors = np.ascontiguousarray(values)
+        missing = np.ascontiguousarray(missing)
+        for sample in range(n_samples):
+            cols = np.flatnonzero(missing[sample])
+            if cols.size == 0:
+                continue
+            rows = candidates[sample]
+            observed = ~missing[rows][:, cols]
+            use = observed & (np.cumsum(observed, axis=0) <= n_neighbors)
+            count = use.sum(axis=0)
+            total = np.where(use, donors[rows][:, cols], 0).sum(axis=0)
+            values[sample, cols] = np.where(count > 0, total / np.maximum(count, 1), feature_mean[cols])
+
+    else:
+        raise ValueError(f"Unknown imputation strategy: {strategy!r}")
+
+    return values
+
+
+def imputation(blk_rem, strategy='lod', seed=IMPUTATION_SEED):
+    """DataFrame version of impute_matrix (first column = sample label)."""
     imp = blk_rem.copy()
-    imp = imp.applymap(lambda x: np.random.randint(1, cutoff_LOD) if x == 0 else x)
+    values = imp.iloc[:, 1:].to_numpy(dtype=np.float32, copy=True)
+    imp.iloc[:, 1:] = impute_matrix(values, strategy=strategy, seed=seed)
 
     return imp
 
@@ -169,10 +808,17 @@ def imputation(blk_rem):
 # In[23]:
 
 
-def blank_processing(ft_t, new_md):
+BLANK_CUTOFF = 0.3
 
-    Cutoff = 0.3
-    print(ft_t.head)
+
+def blank_filter_positions(values, samples, new_md, cutoff=BLANK_CUTOFF):
+    """
+    Positions kept by the blank removal on a samples x features array.
+
+    Returns (sample_rows, feature_cols, md_Samples): the rows of the non-blank samples,
+    the columns whose blank/sample ratio is not above `cutoff`, and their metadata.
+    `samples` are the row labels of `values`, `new_md` is indexed by sample name.
+    """
     # Automatically find the first column that contains the word 'Blank' in any of its values
     blank_column = None
     for col in new_md.columns:
@@ -195,40 +841,34 @@ def blank_processing(ft_t, new_md):
     # All other levels can be considered samples (you can refine this if needed)
     sample_levels = [lvl for lvl in unique_levels if lvl not in blank_levels]
     
-    # Check that filename column exists
-    #assert 'filename' in new_md.columns, "'filename' column missing in metadata."
-    
-        # Filter for blanks
     md_Blank = new_md[new_md[sample_attribute].isin(blank_levels)]
-    Blank = ft_t[ft_t.index.isin(md_Blank.index)]
-    
-    # Filter for samples
     md_Samples = new_md[new_md[sample_attribute].isin(sample_levels)]
-    Samples = ft_t[ft_t.index.isin(md_Samples.index)]
-    
-    
-    # Getting mean for every feature in blank and Samples in a DataFrame named 'Avg_ft'
-    Avg_ft = pd.DataFrame({'Avg_blank': Blank.mean(axis=0, skipna=False)}) # Set skipna=False to check if there are NA values
-    Avg_ft['Avg_samples'] = Samples.mean(axis=0, skipna=False) # Adding another column 'Avg_samples' for feature means of samples
-    
-    # Getting the ratio of blank vs Sample
-    Avg_ft['Ratio_blank_Sample'] = (Avg_ft['Avg_blank'] + 1) / (Avg_ft['Avg_samples'] + 1)
-    
-    # Creating a bin with 1s when the ratio > Cutoff, else put 0s
-    Avg_ft['Bg_bin'] = (Avg_ft['Ratio_blank_Sample'] > Cutoff).astype(int)
-    
+    samples = pd.Index(samples)
+    blank_rows = np.flatnonzero(samples.isin(md_Blank.index))
+    sample_rows = np.flatnonzero(samples.isin(md_Samples.index))
+
+    # Feature means of blanks and samples (NaN propagates, like skipna=False)
+    avg_blank = values[blank_rows].mean(axis=0, dtype=np.float64)
+    avg_samples = values[sample_rows].mean(axis=0, dtype=np.float64)
+
+    # Background when the blank vs sample ratio > cutoff
+    background = (avg_blank + 1) / (avg_samples + 1) > cutoff
+    feature_cols = np.flatnonzero(~background)
+
     # Calculating the number of background features and features present
-    print("Total no.of features:", Samples.shape[1])
-    print("No.of Background or noise features:", Avg_ft['Bg_bin'].sum())
-    print("No.of features after excluding noise:", (Samples.shape[1] - Avg_ft['Bg_bin'].sum()))
-    
-    # Merging Samples with Avg_ft and selecting only the required rows and columns
-    blk_rem = pd.concat([Samples.T, Avg_ft], axis=1, join='inner')
-    blk_rem = blk_rem[blk_rem['Bg_bin'] == 0]  # Picking only the features
-    blk_rem = blk_rem.drop(columns=['Avg_blank', 'Avg_samples', 'Ratio_blank_Sample', 'Bg_bin'])  # Removing the last 4 columns
+    print("Total no.of features:", values.shape[1])
+    print("No.of Background or noise features:", int(background.sum()))
+    print("No.of features after excluding noise:", feature_cols.size)
+
+    return sample_rows, feature_cols, md_Samples
+
+
+def blank_processing(ft_t, new_md, cutoff=BLANK_CUTOFF):
+    sample_rows, feature_cols, md_Samples = blank_filter_positions(
+        ft_t.to_numpy(), ft_t.index, new_md, cutoff)
+
+    blk_rem = ft_t.iloc[sample_rows, feature_cols].copy()
     md_Samples.index.name = 'name_file'
-    #
-    blk_rem = blk_rem.T
     blk_rem.index.name = 'filename'      # samples on rows
     blk_rem.columns.name = 'compound_name'  # features on columns
     md_Samples = md_Samples.reset_index()
@@ -239,10 +879,124 @@ def blank_processing(ft_t, new_md):
 # In[24]:
 
 
-def combine_names(row):
-    if row['name'] == row['pubchemids']:
-        return row['name']
-    return ';'.join([str(row['name']), str(row['pubchemids'])])
+PREPROCESSING_STAGES = ('blanked', 'imputed', 'normalized', 'scaled')
+
+
+def run_preprocessing(source, source_stage, outputs, metadata=None,
+                      blank_cutoff=BLANK_CUTOFF, imputation_strategy='lod'):
+    """
+    Run blank -> impute -> normalize / scale on a single float32 working array.
+
+    source       : StageMatrix of `source_stage` ('raw', 'blanked' or 'imputed')
+    outputs      : {stage: key} of the stages to write; each one is written once
+    metadata     : sample metadata indexed by sample name (only needed from 'raw')
+
+    Only the steps leading to the requested stages are run. Normalized and scaled are
+    both derived from the imputed stage, as in the notebook pipeline.
+    """
+    samples, features = list(source.samples), list(source.features)
+    wanted = set(outputs)
+
+    # Steps that will run, for the progress bar of a background job
+    steps = (['blanked'] if source_stage == 'raw' else []) \
+        + (['imputed'] if wanted - {'blanked'} and source_stage in ('raw', 'blanked') else []) \
+        + [stage for stage in ('scaled', 'normalized') if stage in wanted]
+    labels = {'blanked': "Blank subtraction", 'imputed': "Imputation",
+              'scaled': "Scaling", 'normalized': "Normalization"}
+
+    def step(stage):
+        report_progress(steps.index(stage), len(steps), labels[stage])
+
+    def save(stage, values):
+        if stage in outputs:
+            matrix_save(outputs[stage], values, samples, features, source.label)
+
+    if source_stage == 'raw':
+        step('blanked')
+        # Blank removal selects rows/columns straight from the memory map: the
+        # kept block is the one working copy
+        sample_rows, feature_cols, _ = blank_filter_positions(
+            source.values, samples, metadata, blank_cutoff)
+        values = np.asfortranarray(np.asarray(source.values)[np.ix_(sample_rows, feature_cols)],
+                                   dtype=np.float32)
+        samples = [samples[i] for i in sample_rows]
+        features = [features[j] for j in feature_cols]
+        save('blanked', values)
+        source_stage = 'blanked'
+    else:
+        values = np.array(source.values, dtype=np.float32, order='F')
+
+    if source_stage == 'blanked' and wanted - {'blanked'}:
+        step('imputed')
+        impute_matrix(values, strategy=imputation_strategy)
+        save('imputed', values)
+
+    if 'scaled' in wanted:
+        step('scaled')
+        # Scaled needs its own buffer only when normalized still needs the imputed values
+        out = np.empty_like(values) if 'normalized' in wanted else None
+        save('scaled', scale_features(values, out=out))
+    if 'normalized' in wanted:
+        step('normalized')
+        save('normalized', normalize_rows(values))
+
+    return outputs
+
+
+# Stage graph: stage -> (parent stage, parameters it depends on). A stage key hashes
+# the parent's key with the stage's parameter values, so changing a parameter re-keys
+# that stage and everything below it, while the stages above stay cached.
+PIPELINE_GRAPH = {
+    'blanked':    ('raw', ('blank_cutoff',)),
+    'imputed':    ('blanked', ('imputation_strategy',)),
+    'normalized': ('imputed', ()),
+    'scaled':     ('imputed', ()),
+}
+PIPELINE_DEFAULTS = {'blank_cutoff': BLANK_CUTOFF, 'imputation_strategy': 'lod'}
+
+
+def pipeline_keys(raw_key, params):
+    """Stage keys of every stage derived from `raw_key` with `params` (shared, see make_stage_key)."""
+    params = {**PIPELINE_DEFAULTS, **{k: v for k, v in params.items() if v is not None}}
+    keys = {'raw': raw_key}
+    for stage, (parent, names) in PIPELINE_GRAPH.items():  # parents come first
+        keys[stage] = make_stage_key(None, stage, keys[parent],
+                                     *(f"{name}={params[name]}" for name in names))
+    return keys
+
+
+def materialize_stages(raw_key, targets, params, metadata=None):
+    """
+    Make sure the `targets` stages exist on disk.
+
+    Missing stages are computed in one run_preprocessing pass, starting from the closest
+    cached ancestor; every missing stage on the way is written too.
+    Returns (keys, computed): all stage keys, and the stages that were computed.
+    """
+    params = {**PIPELINE_DEFAULTS, **{k: v for k, v in params.items() if v is not None}}
+    keys = pipeline_keys(raw_key, params)
+
+    missing = set()
+    for stage in targets:
+        while stage != 'raw' and stage not in missing and not matrix_has(keys[stage]):
+            missing.add(stage)
+            stage = PIPELINE_GRAPH[stage][0]
+    if not missing:
+        return keys, []
+
+    first = next(stage for stage in PIPELINE_GRAPH if stage in missing)
+    source_stage = PIPELINE_GRAPH[first][0]
+    source = matrix_get(keys[source_stage])
+    if source is None:
+        raise ValueError(f"Cached {source_stage.upper()} data not found.")
+    if source_stage == 'raw' and metadata is None:
+        raise ValueError("Metadata is required for blank subtraction.")
+
+    outputs = {stage: keys[stage] for stage in PIPELINE_GRAPH if stage in missing}
+    run_preprocessing(source, source_stage, outputs, metadata,
+                      blank_cutoff=params['blank_cutoff'],
+                      imputation_strategy=params['imputation_strategy'])
+    return keys, list(outputs)
 
 
 # In[25]:
@@ -274,67 +1028,314 @@ def convert_commas_to_floats(df):
 # In[27]:
 
 
-def filter_merged_dataset(cleaned_data, metadata, ft_sirius, attribute_name,
-                          sample_locations, threshold,
-                          filter_class, filter_prob, filter_sirius,selected_compounds):
-    
-    if not sample_locations:
-        return pd.DataFrame()
-        
-    if isinstance(sample_locations, str):
-        sample_locations = [sample_locations]
+def select_sample_rows(cleaned_data, metadata, attribute_name, sample_locations):
+    """
+    Row positions (or a full slice) of `cleaned_data` (indexed by filename) whose
+    sample belongs to `sample_locations`, in matrix order, plus the matching
+    metadata rows.
+    Taking these rows replaces merging the whole matrix with the metadata.
+    """
+    if 'filename' in metadata.columns:
+        metadata = metadata.set_index('filename')
+    metadata = metadata[metadata[attribute_name].isin(sample_locations)]
+    mask = cleaned_data.index.isin(metadata.index)
+    # All samples selected: a slice keeps .iloc a view of the (memory-mapped) matrix
+    rows = slice(None) if mask.all() else np.flatnonzero(mask)
+    return rows, metadata.reindex(cleaned_data.index[rows])
 
-    # 💡 NEW: filter cleaned_data columns by selected_compounds, if provided
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col  # partial match; or name.lower() in col.lower() for case-insensitive
-        ]
-        if matched_columns:  # only keep if something matched
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            # Nothing matched; return empty dataframe early
-            return pd.DataFrame()
 
-        # Also filter ft_sirius to those compounds
-        # Because ft_sirius['compound_name'] usually contains just the compound name part
-        mask = ft_sirius['compound_name'].apply(
-        lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
-            return pd.DataFrame()
-    
-    # Merge peak areas with metadata
-    merged_md = pd.merge(cleaned_data, metadata, on='filename')
-    merged_md = merged_md[merged_md[attribute_name].isin(sample_locations)]
+# ---- Metadata bitmap index ----
+# Sample selections (primary attribute and levels, optional secondary attribute and
+# levels) are resolved on an index built once per metadata stage: for every attribute,
+# one packed bitmap over the samples per level. A selection is an OR of the bitmaps of
+# its levels, AND the secondary selection, and gives the rows to take from the stage
+# matrix without filtering or joining the metadata table.
+MetadataIndex = namedtuple("MetadataIndex", ["samples", "levels", "codes", "bitmaps"])
+
+
+def build_metadata_index(metadata):
+    """
+    MetadataIndex of a metadata table (first column: the sample filename):
+
+    samples : the filenames, as a pd.Index of strings, in metadata order
+    levels  : per attribute, its distinct values in order of appearance (NaN skipped)
+    codes   : per attribute, the position in levels of each sample's value (-1 for NaN)
+    bitmaps : per attribute and level, np.packbits of the samples with that value
+    """
+    samples = pd.Index(metadata.iloc[:, 0].astype(str), name='filename')
+    levels, codes, bitmaps = {}, {}, {}
+    for attribute in metadata.columns[1:]:
+        attribute_codes, attribute_levels = pd.factorize(metadata[attribute])
+        levels[attribute] = attribute_levels
+        codes[attribute] = attribute_codes
+        bitmaps[attribute] = {level: np.packbits(attribute_codes == i)
+                              for i, level in enumerate(attribute_levels)}
+    return MetadataIndex(samples, levels, codes, bitmaps)
+
+
+def metadata_index(metadata_key):
+    """Bitmap index of a metadata stage, built on first use, or None if there is no stage."""
+    if not cache_has(metadata_key):
+        return None
+    return cached_index(('metadata', metadata_key), lambda: build_metadata_index(cache_get(metadata_key)))
+
+
+def sample_mask(index, attribute, levels):
+    """Boolean array over index.samples: the samples whose `attribute` is one of `levels`."""
+    bits = np.zeros((len(index.samples) + 7) // 8, dtype=np.uint8)
+    for level in levels:
+        level_bits = index.bitmaps.get(attribute, {}).get(level)
+        if level_bits is not None:
+            bits |= level_bits
+    return np.unpackbits(bits, count=len(index.samples)).astype(bool)
+
+
+def sample_labels(index, attribute, samples, mask=None):
+    """
+    `attribute` value of each of `samples` (filenames, e.g. the rows of a stage) as a
+    Series indexed by them; NaN for samples missing from the metadata or outside `mask`
+    (a boolean array over index.samples).
+    """
+    samples = pd.Index(samples).astype(str)
+    rows = index.samples.get_indexer(samples)
+    keep = rows >= 0
+    if mask is not None:
+        keep &= mask[rows]
+    codes = np.where(keep, index.codes[attribute][rows], -1)
+    labels = pd.Categorical.from_codes(codes, categories=index.levels[attribute])
+    return pd.Series(labels, index=samples, name=attribute).astype(object)
+
+
+# ---- Group aggregates shared by the plot tabs ----
+# Every tab works on per-group feature averages. They are computed here in one pass
+# over the stage matrix per (stage, attribute, sample grouping) and cached next to
+# the stage, so tab switches and slider moves only read small group x feature tables.
+# Each new sample grouping adds a set of tables: only the GROUP_TABLES_KEEP most
+# recently used sets of a session are kept.
+GroupTables = namedtuple("GroupTables", ["mean", "count", "quantiles", "order"], defaults=[None])
+GROUP_QUANTILE_LEVELS = np.round(np.arange(101) / 100, 2)  # threshold-slider steps
+GROUP_TABLES_KEEP = 32
+GROUP_TABLE_KINDS = ('group-mean', 'group-count', 'group-quantiles')
+
+
+def prune_group_tables(session_id, keep=GROUP_TABLES_KEEP):
+    """Delete a session's group tables beyond the `keep` most recently used sets."""
+    # The three tables of a set share the hash part of their keys; the mean file's
+    # modification time is the set's last use (see group_tables)
+    session = session_id or 'shared'
+    prefix = os.path.basename(stage_path(f"{session}:group-mean:", ""))
+    sets = []
+    for entry in os.scandir(STAGE_DIR):
+        if entry.name.startswith(prefix) and entry.name.endswith(".f32.npy"):
+            try:
+                sets.append((entry.stat().st_mtime, entry.name[len(prefix):-len(".f32.npy")]))
+            except OSError:
+                pass
+    for _, digest in sorted(sets, reverse=True)[keep:]:
+        for kind in GROUP_TABLE_KINDS:
+            matrix_delete(f"{session}:{kind}:{digest}")
+
+
+def group_tables(session_id, stage_key, stage, labels, attribute_name):
+    """
+    Group x feature tables of a stage for one metadata attribute (groups as strings):
+
+    mean      : average of each feature over the group's samples (NaN skipped)
+    count     : number of samples behind each average
+    quantiles : per group, quantiles of the averages at GROUP_QUANTILE_LEVELS
+    order     : per group, the feature positions sorted by average (NaN last), built in
+                memory on first use for the intensity cutoffs (see average_cutoff)
+
+    `labels` holds the group of each stage sample, in stage order (see sample_labels);
+    samples labelled NaN belong to no group.
+    """
+    key_parts = (stage_key, attribute_name, labels.tolist())
+    mean_key, count_key, quantile_key = (make_stage_key(session_id, kind, *key_parts)
+                                         for kind in GROUP_TABLE_KINDS)
+
+    if matrix_has(mean_key) and matrix_has(count_key) and matrix_has(quantile_key):
+        touch_stage(mean_key, ".f32.npy")  # last use, for prune_group_tables
+    else:
+        groups = list(dict.fromkeys(labels.dropna().tolist()))
+        sums = np.zeros((len(groups), len(stage.features)))
+        counts = np.zeros((len(groups), len(stage.features)))
+        for i, group in enumerate(groups):
+            block = stage.values[np.flatnonzero((labels == group).to_numpy())]
+            observed = ~np.isnan(block)
+            sums[i] = np.where(observed, block, 0).sum(axis=0, dtype=np.float64)
+            counts[i] = observed.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # groups without any value
+            means = (sums / counts).astype(np.float32)
+            quantiles = np.nanquantile(means.astype(np.float64), GROUP_QUANTILE_LEVELS, axis=1).T
+
+        matrix_save(quantile_key, quantiles, groups, [f"{q:.2f}" for q in GROUP_QUANTILE_LEVELS], attribute_name)
+        matrix_save(count_key, counts, groups, stage.features, attribute_name)
+        matrix_save(mean_key, means, groups, stage.features, attribute_name)
+        prune_group_tables(session_id)
+
+    mean = matrix_frame(matrix_get(mean_key))
+    return GroupTables(
+        mean=mean,
+        count=matrix_frame(matrix_get(count_key)),
+        quantiles=matrix_frame(matrix_get(quantile_key)),
+        order=cached_index(('group-order', mean_key), lambda: np.argsort(mean.to_numpy(), axis=1)),
+    )
+
+
+def select_features(tables, ft_sirius, selected_features):
+    """
+    Limit the tables and ft_sirius (all features, in id order) to `selected_features`,
+    the ids from resolve_selection. Returns (None, None) when nothing matches.
+    """
+    if selected_features is None:
+        return tables, ft_sirius
+
+    ft_sirius = ft_sirius.iloc[selected_features]
+    columns = tables.mean.columns.intersection(selected_features, sort=False)
+    if columns.empty or ft_sirius.empty:
+        return None, None
+
+    # The precomputed quantiles and sort orders cover all features, not this subset
+    return GroupTables(tables.mean[columns], tables.count[columns], None, None), ft_sirius
 
-    # Compute average intensity across X columns
-    filtered_X = merged_md.loc[:, merged_md.columns.str.startswith('X')]
-    row_avg = filtered_X.T.mean(axis=1)
 
-    averaged_df = pd.DataFrame({
-        'compound_name': cleaned_data.T.index,
-        'average': row_avg
-    }).set_index('compound_name')
+def group_average(tables, locations):
+    """Average of each feature over all samples of `locations` (count-weighted group means)."""
+    groups = [str(location) for location in locations]
+    mean = tables.mean.reindex(groups).to_numpy(dtype=np.float64)
+    count = tables.count.reindex(groups).fillna(0).to_numpy(dtype=np.float64)
+    total = np.nansum(mean * count, axis=0)
+    n = count.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average = np.where(n > 0, total / n, np.nan).astype(np.float32)
+    return pd.Series(average, index=tables.mean.columns)
 
-    # Merge with ft_sirius
-    merged = pd.merge(ft_sirius, averaged_df, on='compound_name')
 
-    # Apply intensity threshold filter
-    cutoff_value = merged['average'].quantile(1 - threshold)
-    merged = merged[merged['average'] > cutoff_value]
+# ---- Slider filters ----
+# The intensity, CANOPUS and SIRIUS sliders only move thresholds over per-feature values
+# that do not change while dragging. The score filters become one boolean mask (with the
+# lowest of the three NPC probabilities taken once per feature instead of three chained
+# filters), and a group's intensity cutoff is read from its quantile table or picked out
+# of its presorted averages (GroupTables.order), so no slider position sorts or copies
+# the annotation table more than once.
+NPC_PROBABILITIES = ['NPC#pathway Probability', 'NPC#superclass Probability', 'NPC#class Probability']
 
-    # Apply Sirius and NPC filters
+
+def score_mask(ft, filter_class=None, filter_prob=None, filter_sirius=None, class_col='NPC#pathway'):
+    """
+    Boolean array over the rows of `ft`: class in filter_class (by class_col), all three
+    NPC probabilities > filter_prob and SiriusScoreNormalized > filter_sirius. Filters
+    that are not set keep every row.
+    """
+    mask = np.ones(len(ft), dtype=bool)
     if filter_class:
-        merged = merged[merged['NPC#class'].isin(filter_class)]
+        mask &= ft[class_col].isin(filter_class).to_numpy()
     if filter_prob:
-        merged = merged[merged['NPC#pathway Probability'] > filter_prob]
-        merged = merged[merged['NPC#superclass Probability'] > filter_prob]
-        merged = merged[merged['NPC#class Probability'] > filter_prob]
+        # NaN in any of the three fails, as with the chained filters
+        min_probability = np.minimum.reduce([ft[col].to_numpy(dtype=np.float32) for col in NPC_PROBABILITIES])
+        mask &= min_probability > filter_prob
     if filter_sirius:
-        merged = merged[merged['SiriusScoreNormalized'] > filter_sirius]
+        mask &= ft['SiriusScoreNormalized'].to_numpy(dtype=np.float32) > filter_sirius
+    return mask
+
+
+def average_cutoff(tables, location, threshold, positions=None):
+    """
+    Intensity cutoff of a group: the (1 - threshold) quantile (linear, NaN skipped) of its
+    averages over the features at `positions` (columns of tables.mean, all when None).
+
+    From the quantile table when every feature counts, else from the presorted averages
+    (the features at `positions` are picked out of tables.order, nothing is sorted here).
+    """
+    group = str(location)
+    if group not in tables.mean.index:
+        return np.nan
+    every_feature = positions is None or len(positions) == tables.mean.shape[1]
+    if every_feature and tables.quantiles is not None and group in tables.quantiles.index:
+        return float(tables.quantiles.at[group, f"{1 - threshold:.2f}"])
+
+    row = tables.mean.index.get_loc(group)
+    averages = tables.mean.iloc[row].to_numpy(dtype=np.float64)
+    if tables.order is not None:
+        order = tables.order[row]
+        if not every_feature:
+            picked = np.zeros(len(averages), dtype=bool)
+            picked[positions] = True
+            order = order[picked[order]]
+        values = averages[order]
+        values = values[:len(values) - np.isnan(values).sum()]  # NaN sort last
+    else:
+        values = np.sort(averages if every_feature else averages[positions])
+        values = values[~np.isnan(values)]
+    if not len(values):
+        return np.nan
+    position = (1 - threshold) * (len(values) - 1)
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return float(values[low] + (values[high] - values[low]) * (position - low))
+
+
+def annotated_features(tables, ft_sirius):
+    """
+    The ft_sirius rows of the features in the tables (in ft_sirius order, like an inner
+    merge on 'feature_id') and their column positions in tables.mean.
+    """
+    features = tables.mean.columns
+    annotated = ft_sirius[ft_sirius['feature_id'].isin(features)].reset_index(drop=True)
+    return annotated, features.get_indexer(annotated['feature_id'])
+
+
+def filtered_locations(tables, ft_sirius, locations, threshold, filter_class=None,
+                       filter_prob=None, filter_sirius=None, class_col='NPC#pathway',
+                       cutoff_after_filters=False):
+    """
+    Yield (location, merged) for each location: the annotated features (see
+    annotated_features) above the location's intensity cutoff and passing the score
+    filters (score_mask), with the location's average in an 'average' column.
+
+    The cutoff is taken over all features of the location, or over the features passing
+    the score filters with cutoff_after_filters.
+    """
+    annotated, positions = annotated_features(tables, ft_sirius)
+    passed = score_mask(annotated, filter_class, filter_prob, filter_sirius, class_col)
+    cutoff_positions = positions[passed] if cutoff_after_filters else positions
+    means = tables.mean.reindex([str(location) for location in locations]).to_numpy()
+    for location, mean in zip(locations, means):
+        average = mean[positions]
+        keep = passed & (average > average_cutoff(tables, location, threshold, cutoff_positions))
+        yield location, annotated[keep].assign(average=average[keep])
+
+
+def filter_merged_dataset(tables, ft_sirius, sample_locations, threshold,
+                          filter_class, filter_prob, filter_sirius, selected_features):
+    
+    if not sample_locations:
+        return pd.DataFrame()
+        
+    if isinstance(sample_locations, str):
+        sample_locations = [sample_locations]
+
+    # 💡 NEW: keep only the selected compounds, if provided
+    tables, ft_sirius = select_features(tables, ft_sirius, selected_features)
+    if tables is None:
+        # Nothing matched; return empty dataframe early
+        return pd.DataFrame()
+    
+    # Average intensity of the selected samples, from the group tables, next to the
+    # ft_sirius rows of the features
+    merged, positions = annotated_features(tables, ft_sirius)
+    average = group_average(tables, sample_locations).to_numpy()[positions]
+
+    # Intensity threshold (a single location has its own cutoffs), Sirius and NPC
+    # filters, applied as one mask
+    if len(sample_locations) == 1:
+        cutoff_value = average_cutoff(tables, sample_locations[0], threshold)
+    else:
+        cutoff_value = pd.Series(average).quantile(1 - threshold)
+    keep = (average > cutoff_value) & score_mask(merged, filter_class, filter_prob, filter_sirius,
+                                                 class_col='NPC#class')
+    merged = merged[keep].assign(average=average[keep])
 
     return merged.fillna("Unclassified")
 
@@ -342,10 +1343,9 @@ def filter_merged_dataset(cleaned_data, metadata, ft_sirius, attribute_name,
 # In[28]:
 
 
-def process_and_plot_barplot_NPC(cleaned_data, metadata, ft_sirius, attribute_name,
-                                  sample_locations, threshold, node_color_map,
+def process_and_plot_barplot_NPC(tables, ft_sirius, sample_locations, threshold, node_color_map,
                                   filter_class, filter_prob, filter_sirius,
-                                  group_cols, type_plot, selected_compounds = None):
+                                  group_cols, type_plot, selected_features = None):
     import pandas as pd
     import plotly.graph_objects as go
     from plotly.subplots import make_subplots
@@ -354,26 +1354,9 @@ def process_and_plot_barplot_NPC(cleaned_data, metadata, ft_sirius, attribute_na
         return go.Figure()
 
 
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col
-        ]
-        if matched_columns:
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            return go.Figure()
-    
-        mask = ft_sirius['compound_name'].apply(
-            lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
-            return go.Figure()
-            
-    # Merge peak data with metadata
-    cleaned_data_md = pd.merge(cleaned_data, metadata, on='filename')
+    tables, ft_sirius = select_features(tables, ft_sirius, selected_features)
+    if tables is None:
+        return go.Figure()
 
     # Create one subplot per selected group_col
     fig = make_subplots(
@@ -386,36 +1369,16 @@ def process_and_plot_barplot_NPC(cleaned_data, metadata, ft_sirius, attribute_na
     for idx, group_col in enumerate(group_cols, start=1):
         data = {}
 
-        for location in sample_locations:
-            filtered = cleaned_data_md[cleaned_data_md[attribute_name] == location]
-            filtered_X = filtered.loc[:, filtered.columns.str.startswith('X')]
-            row_avg = filtered_X.T.mean(axis=1)
-
-            averaged_df = pd.DataFrame({
-                'compound_name': cleaned_data.T.index,
-                'average': row_avg
-            }).set_index('compound_name')
-
-            merged = pd.merge(ft_sirius, averaged_df, on='compound_name')
-            cutoff_value = merged['average'].quantile(1 - threshold)
-            merged = merged[merged['average'] > cutoff_value]
-
-            if filter_class:
-                merged = merged[merged[group_col].isin(filter_class)]
-            if filter_prob:
-                merged = merged[merged['NPC#pathway Probability'] > filter_prob]
-                merged = merged[merged['NPC#superclass Probability'] > filter_prob]
-                merged = merged[merged['NPC#class Probability'] > filter_prob]
-            if filter_sirius:
-                merged = merged[merged['SiriusScoreNormalized'] > filter_sirius]
-
+        for location, merged in filtered_locations(tables, ft_sirius, sample_locations, threshold,
+                                                   filter_class, filter_prob, filter_sirius,
+                                                   class_col=group_col):
             merged = merged.fillna('Unclassified')
 
             # Group by group_col and store per sample
             if type_plot == 'Intensity':
-                grouped = merged.groupby(group_col)['average'].mean()
+                grouped = merged.groupby(group_col, observed=True)['average'].mean()
             elif type_plot == 'Count':
-                grouped = merged.groupby(group_col)['average'].count()
+                grouped = merged.groupby(group_col, observed=True)['average'].count()
 
             for group_name, val in grouped.items():
                 if group_name not in data:
@@ -450,11 +1413,53 @@ def process_and_plot_barplot_NPC(cleaned_data, metadata, ft_sirius, attribute_na
 # In[29]:
 
 
+# Box plots. Up to BOX_MAX_POINTS values over all boxes every value is sent (box + points);
+# beyond that, and unless compounds are selected, the box statistics are computed here and
+# plotly only draws them.
+BOX_MAX_POINTS = 10_000
+
+
+def box_statistics(frame, keys, value='average'):
+    """
+    Box statistics of frame[value] per group of the `keys` columns (groups in order of first
+    appearance): n, q1, median, q3, lowerfence / upperfence (the furthest values within
+    1.5 IQR of the box), mean and sd, computed the way plotly computes them from raw values.
+    """
+    grouped = frame.groupby(keys, sort=False, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    order = np.lexsort((frame[value].to_numpy(), codes))
+    values = frame[value].to_numpy(dtype=np.float64)[order]
+    codes = codes[order]
+    n = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+
+    def quantile(p):
+        # plotly's interpolation: position p * n - 0.5 in the sorted values, clamped
+        position = np.clip(p * n - 0.5, 0, n - 1)
+        low = np.floor(position).astype(np.int64)
+        fraction = position - low
+        return (values[starts + low] * (1 - fraction)
+                + values[starts + np.ceil(position).astype(np.int64)] * fraction)
+
+    q1, median, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    inside_low = values >= (q1 - 1.5 * iqr)[codes]
+    inside_high = values <= (q3 + 1.5 * iqr)[codes]
+    mean = np.add.reduceat(values, starts) / n
+    stats = frame.loc[:, keys].iloc[order[starts]].reset_index(drop=True)
+    stats['n'] = n
+    stats['q1'], stats['median'], stats['q3'] = q1, median, q3
+    stats['lowerfence'] = np.minimum.reduceat(np.where(inside_low, values, np.inf), starts)
+    stats['upperfence'] = np.maximum.reduceat(np.where(inside_high, values, -np.inf), starts)
+    stats['mean'] = mean
+    stats['sd'] = np.sqrt(np.add.reduceat((values - mean[codes]) ** 2, starts) / n)
+    return stats
+
+
 def process_and_plot_lineplot_NPC(
-    cleaned_data, metadata, ft_sirius, attribute_name,
-    sample_locations, threshold, node_color_map,
+    tables, ft_sirius, sample_locations, threshold, node_color_map,
     filter_class, filter_prob, filter_sirius,
-    group_cols, type_plot,  selected_compounds=None ):
+    group_cols, type_plot,  selected_features=None ):
     import pandas as pd
     import plotly.graph_objects as go
     import math
@@ -468,27 +1473,9 @@ def process_and_plot_lineplot_NPC(
     if isinstance(group_cols, str):
         group_cols = [group_cols]
         
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col
-        ]
-        if matched_columns:
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            return go.Figure()
-    
-        mask = ft_sirius['compound_name'].apply(
-            lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
-            return go.Figure()
-    
-                 
-    # Merge peak data with metadata
-    cleaned_data_md = pd.merge(cleaned_data, metadata, on='filename')
+    tables, ft_sirius = select_features(tables, ft_sirius, selected_features)
+    if tables is None:
+        return go.Figure()
 
     # Collect all unique (group_col, group_value) combinations
     unique_groups = []
@@ -508,42 +1495,18 @@ def process_and_plot_lineplot_NPC(
     fig = make_subplots(
         rows=n_rows, cols=n_cols,
         subplot_titles=[f"{col}: {val}" for col, val in unique_groups],
-        vertical_spacing=0.05,   # a bit more space vertically
+        # a bit more space vertically (plotly caps it at 1 / (rows - 1) for tall grids)
+        vertical_spacing=min(0.05, 0.5 / max(n_rows - 1, 1)),
         horizontal_spacing=0.05  # space between columns
     )
-    for idx, (group_col, group_value) in enumerate(unique_groups, start=0):
-        # Collect data per sample_location
-        traces = []
-
-        for location in sample_locations:
-            # Filter metadata to this sample location
-            filtered = cleaned_data_md[cleaned_data_md[attribute_name] == location]
-            filtered_X = filtered.loc[:, filtered.columns.str.startswith('X')]
-            row_avg = filtered_X.T.mean(axis=1)
-        
-            averaged_df = pd.DataFrame({
-                'compound_name': cleaned_data.T.index,
-                'average': row_avg
-            }).set_index('compound_name')
-        
-            merged = pd.merge(ft_sirius, averaged_df, on='compound_name')
-            cutoff_value = merged['average'].quantile(1 - threshold)
-            merged = merged[merged['average'] > cutoff_value]
-        
-            # Apply filters
-            if filter_class:
-                merged = merged[merged[group_col].isin(filter_class)]
-            if filter_prob:
-                merged = merged[merged['NPC#pathway Probability'] > filter_prob]
-                merged = merged[merged['NPC#superclass Probability'] > filter_prob]
-                merged = merged[merged['NPC#class Probability'] > filter_prob]
-            if filter_sirius:
-                merged = merged[merged['SiriusScoreNormalized'] > filter_sirius]
-
-
-
-            
-            
+    # The threshold cutoff, filters and outlier removal only depend on the location
+    # (and on group_col through the class filter), not on the group value: run them
+    # once per (group_col, location) and split the result by group value
+    filtered = []
+    for group_col in group_cols:
+        for location, merged in filtered_locations(tables, ft_sirius, sample_locations, threshold,
+                                                   filter_class, filter_prob, filter_sirius,
+                                                   class_col=group_col):
             # remove outliers
             Q1 = merged['average'].quantile(0.25)
             Q3 = merged['average'].quantile(0.75)
@@ -551,13 +1514,47 @@ def process_and_plot_lineplot_NPC(
             lower_bound = Q1 - 1.5 * IQR
             upper_bound = Q3 + 1.5 * IQR
             merged = merged[(merged['average'] >= lower_bound) & (merged['average'] <= upper_bound)]
+            filtered.append((group_col, location, merged))
+
+    # Every value as a point (and in the box) for compound browsing or small plots, box
+    # statistics only otherwise
+    if selected_features is None and sum(len(merged) for *_, merged in filtered) > BOX_MAX_POINTS:
+        traces, rows, cols = box_statistics_traces(filtered, unique_groups, sample_locations,
+                                                   node_color_map, n_cols)
+    else:
+        traces, rows, cols = box_point_traces(filtered, unique_groups, sample_locations,
+                                              node_color_map, n_cols, selected_features)
+
+    # One call for all subplots instead of one layout update per trace
+    fig.add_traces(traces, rows=rows, cols=cols)
+    fig.update_xaxes(categoryorder='array', categoryarray=sample_locations)
+            
+    fig.update_layout(height=300 * n_rows, width=400 * n_cols,
+                      template="simple_white")
+
+    return fig
+
+
+def box_point_traces(filtered, unique_groups, sample_locations, node_color_map, n_cols,
+                     selected_features=None):
+    """
+    Box and point traces of the line_plot tab from the raw values: for each (group_col,
+    group_value) subplot and location, a go.Box of the values and a go.Scatter of the points
+    (labelled when compounds are selected). Returns (traces, rows, cols).
+    """
+    subsets = {}
+    for group_col, location, merged in filtered:
+        for group_value, subset in merged.groupby(group_col, sort=False, observed=True):
+            subsets[(group_col, group_value, location)] = subset
+
+    traces, rows, cols = [], [], []
+    for idx, (group_col, group_value) in enumerate(unique_groups, start=0):
+        color = node_color_map.get(group_value, '#CCCCCC')
+
+        for location in sample_locations:
+            subset = subsets.get((group_col, group_value, location))
         
-            # Filter to current group_value
-            subset = merged[merged[group_col] == group_value]
-        
-            color = node_color_map.get(group_value, '#CCCCCC')
-        
-            if subset.empty:
+            if subset is None:
                 # add empty box for this location
                 trace_box = go.Box(
                     y=[None],
@@ -585,9 +1582,9 @@ def process_and_plot_lineplot_NPC(
                 trace_scatter = go.Scatter(
                     x=[location]*len(subset),
                     y=subset['average'],
-                    mode='markers+text' if selected_compounds else 'markers',
+                    mode='markers+text' if selected_features is not None else 'markers',
                     marker=dict(size=6, color=node_color_map.get(group_value, '#999999')),
-                    hovertext=subset['compound_name'] if selected_compounds else None,
+                    hovertext=feature_labels(subset) if selected_features is not None else None,
                     hoverinfo='text+y',
                     textposition='top center',
                     name=f"{location}",
@@ -597,23 +1594,136 @@ def process_and_plot_lineplot_NPC(
             row_idx = idx // n_cols + 1
             col_idx = idx % n_cols + 1
         
-            fig.add_trace(trace_box, row=row_idx, col=col_idx)
-            fig.add_trace(trace_scatter, row=row_idx, col=col_idx)
-            
-    for i in range(1, n_rows * n_cols + 1):
-        fig.update_xaxes(categoryorder='array', categoryarray=sample_locations, row=(i-1)//n_cols+1, col=(i-1)%n_cols+1)
-            
-    fig.update_layout(height=300 * n_rows, width=400 * n_cols,
-                      template="simple_white")
+            traces += [trace_box, trace_scatter]
+            rows += [row_idx, row_idx]
+            cols += [col_idx, col_idx]
 
-    return fig
+    return traces, rows, cols
+
+
+def box_statistics_traces(filtered, unique_groups, sample_locations, node_color_map, n_cols):
+    """
+    Box traces of the line_plot tab from precomputed statistics: one go.Box per (group_col,
+    group_value) subplot with the quartiles, whiskers and mean/sd of each location, computed
+    for all subplots in one pass (box_statistics). No points are sent. Returns
+    (traces, rows, cols).
+    """
+    stacked = pd.concat([
+        pd.DataFrame({'group_col': group_col,
+                      'group_value': merged[group_col].astype(object),
+                      'location': location,
+                      'average': merged['average']})
+        for group_col, location, merged in filtered
+    ], ignore_index=True).dropna(subset=['group_value'])
+    cells = {}
+    if len(stacked):
+        stats = box_statistics(stacked, ['group_col', 'group_value', 'location'])
+        cells = dict(iter(stats.groupby(['group_col', 'group_value'], sort=False)))
+
+    traces, rows, cols = [], [], []
+    for idx, (group_col, group_value) in enumerate(unique_groups, start=0):
+        row_idx = idx // n_cols + 1
+        col_idx = idx % n_cols + 1
+
+        # keep a slot for every location, with or without a box
+        traces.append(go.Scatter(
+            x=sample_locations,
+            y=[None] * len(sample_locations),
+            mode='markers',
+            hoverinfo='skip',
+            showlegend=False
+        ))
+        rows.append(row_idx)
+        cols.append(col_idx)
+
+        cell = cells.get((group_col, group_value))
+        if cell is None:
+            continue
+        traces.append(go.Box(
+            x=cell['location'].to_numpy(),
+            q1=cell['q1'].to_numpy(),
+            median=cell['median'].to_numpy(),
+            q3=cell['q3'].to_numpy(),
+            lowerfence=cell['lowerfence'].to_numpy(),
+            upperfence=cell['upperfence'].to_numpy(),
+            mean=cell['mean'].to_numpy(),
+            sd=cell['sd'].to_numpy(),
+            name='',
+            marker_color=node_color_map.get(group_value, '#CCCCCC'),
+            boxmean='sd',
+            showlegend=False
+        ))
+        rows.append(row_idx)
+        cols.append(col_idx)
+
+    return traces, rows, cols
 
 
 
 # In[30]:
 
 
-def process_and_plot_intensity_NPC(cleaned_data, metadata, ft_sirius, attribute_name, sample_locations, threshold, node_color_map, filter_class, filter_prob, filter_sirius, selected_compounds = None):
+SUNBURST_PATH = ['NPC#pathway', 'NPC#superclass', 'NPC#class']
+
+
+def sunburst_traces(frames, node_color_map, values=None):
+    """
+    One go.Sunburst per frame of `frames`, with the ids / labels / parents / values
+    px.sunburst(frame, path=SUNBURST_PATH, values=values) would build (same nodes, same
+    order: classes, then superclasses, then pathways, each sorted by label then parents),
+    colored with node_color_map.
+
+    The hierarchy is aggregated for all frames at once, one groupby per level, so ten
+    locations cost about as much as one.
+    """
+    if not frames:
+        return []
+    value_name = values or 'count'
+    columns = SUNBURST_PATH + ([values] if values else [])
+    stacked = pd.concat([frame[columns].assign(_frame=i) for i, frame in enumerate(frames)],
+                        ignore_index=True)
+    if values is None:
+        stacked[value_name] = 1
+
+    levels = SUNBURST_PATH[::-1]  # leaf first, as px.sunburst
+    nodes = []
+    for depth, level in enumerate(levels):
+        grouped = (stacked.groupby(['_frame'] + levels[depth:], sort=True, observed=True)[value_name]
+                   .sum().reset_index())
+        labels = grouped[level].astype(str)
+        ancestors = [grouped[col].astype(str) for col in SUNBURST_PATH[:len(SUNBURST_PATH) - depth - 1]]
+        parents = pd.Series('', index=grouped.index)
+        for i, ancestor in enumerate(ancestors):
+            parents = ancestor if i == 0 else parents + '/' + ancestor
+        ids = labels if not ancestors else parents + '/' + labels
+        frame_codes = grouped['_frame'].to_numpy()
+        bounds = np.searchsorted(frame_codes, np.arange(len(frames) + 1))
+        colors = labels.map(node_color_map).fillna('#CCCCCC')  # each node's label to its color
+        nodes.append((bounds, [ids.to_numpy(dtype=str), labels.to_numpy(dtype=str), parents.to_numpy(dtype=str),
+                               grouped[value_name].to_numpy(), colors.to_numpy(dtype=str)]))
+
+    # numpy arrays: plotly validates them as a whole instead of element by element
+    hovertemplate = f"labels=%{{label}}<br>{value_name}=%{{value}}<br>parent=%{{parent}}<br>id=%{{id}}<extra></extra>"
+    traces = []
+    for i in range(len(frames)):
+        ids, labels, parents, node_values, colors = (
+            np.concatenate(arrays) for arrays in
+            zip(*([array[bounds[i]:bounds[i + 1]] for array in arrays] for bounds, arrays in nodes))
+        )
+        traces.append(go.Sunburst(
+            ids=ids,
+            labels=labels,
+            parents=parents,
+            values=node_values,
+            branchvalues='total',
+            name='',
+            hovertemplate=hovertemplate,
+            marker=dict(colors=colors),
+        ))
+    return traces
+
+
+def process_and_plot_intensity_NPC(tables, ft_sirius, sample_locations, threshold, node_color_map, filter_class, filter_prob, filter_sirius, selected_features = None):
     from plotly.subplots import make_subplots
     import plotly.express as px
     import plotly.graph_objects as go
@@ -623,23 +1733,9 @@ def process_and_plot_intensity_NPC(cleaned_data, metadata, ft_sirius, attribute_
     if not sample_locations:
         return go.Figure()  # empty figure to avoid crashing
 
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col
-        ]
-        if matched_columns:
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            return go.Figure()
-    
-        mask = ft_sirius['compound_name'].apply(
-            lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
-            return go.Figure()    
+    tables, ft_sirius = select_features(tables, ft_sirius, selected_features)
+    if tables is None:
+        return go.Figure()    
 
     plots_per_row = 5  # adjust to fit your layout needs
     total_plots = len(sample_locations)
@@ -659,57 +1755,22 @@ def process_and_plot_intensity_NPC(cleaned_data, metadata, ft_sirius, attribute_
         specs=specs
     )
 
-    for idx, location in enumerate(sample_locations):
-        row_idx = idx // plots_per_row + 1
-        col_idx = idx % plots_per_row + 1
-
-        cleaned_data_md = pd.merge(cleaned_data, metadata, on='filename')
-        filtered = cleaned_data_md[cleaned_data_md[attribute_name] == location]
-        filtered_X = filtered.loc[:, filtered.columns.str.startswith('X')]
-        row_avg = filtered_X.T.mean(axis=1)
-
-        averaged_df = pd.DataFrame({
-            'compound_name': cleaned_data.T.index,
-            'average': row_avg
-        }).set_index('compound_name')
-
-        values_raw = averaged_df['average']
-
-        min_val = values_raw.min()
+    # Filter each location, then build the hierarchies of all locations together
+    frames = []
+    for location, merged in filtered_locations(tables, ft_sirius, sample_locations, threshold,
+                                               filter_class, filter_prob, filter_sirius):
+        # Shift to positive values (e.g. scaled data), minimum over all features of the
+        # location (the cutoff does not move with the shift)
+        min_val = tables.mean.reindex([str(location)]).iloc[0].min()
         if min_val <= 0:
-            values = values_raw + abs(min_val) + 1e-6
-        else:
-            values = values_raw
-
-        averaged_df['average'] = values
+            merged['average'] = merged['average'] + abs(min_val) + 1e-6
 
-        merged = pd.merge(ft_sirius, averaged_df, on='compound_name')
-        cutoff_value = merged['average'].quantile(1 - threshold)
-        merged = merged[merged['average'] > cutoff_value]
+        frames.append(merged.fillna('Unclassified'))
 
-        if filter_class:
-            merged = merged[merged['NPC#pathway'].isin(filter_class)]
-        if filter_prob:
-            merged = merged[merged['NPC#pathway Probability'] > filter_prob]
-            merged = merged[merged['NPC#superclass Probability'] > filter_prob]
-            merged = merged[merged['NPC#class Probability'] > filter_prob]
-        if filter_sirius:
-            merged = merged[merged['SiriusScoreNormalized'] > filter_sirius]
-
-        merged = merged.fillna('Unclassified')
-
-        sunburst = px.sunburst(
-            merged,
-            path=['NPC#pathway', 'NPC#superclass', 'NPC#class'],
-            values='average',
-        )
-
-        # Re-map each node's label to its color
-        for trace in sunburst.data:
-            labels = trace.labels
-            trace.marker.colors = [node_color_map.get(label, '#CCCCCC') for label in labels]
-
-            fig.add_trace(trace, row=row_idx, col=col_idx)
+    for idx, trace in enumerate(sunburst_traces(frames, node_color_map, values='average')):
+        row_idx = idx // plots_per_row + 1
+        col_idx = idx % plots_per_row + 1
+        fig.add_trace(trace, row=row_idx, col=col_idx)
 
     fig.update_layout(
         title_text="Sunburst Plots with Distinct Colors Per Node",
@@ -723,30 +1784,16 @@ def process_and_plot_intensity_NPC(cleaned_data, metadata, ft_sirius, attribute_
 # In[31]:
 
 
-def process_and_plot_NPC_count(cleaned_data, metadata, ft_sirius, attribute_name,sample_locations,threshold,node_color_map,filter_class,filter_prob,filter_sirius, selected_compounds = None):
+def process_and_plot_NPC_count(tables, ft_sirius, sample_locations,threshold,node_color_map,filter_class,filter_prob,filter_sirius, selected_features = None):
     from plotly.subplots import make_subplots
     import plotly.express as px
     import pandas as pd
     if not sample_locations:
         return go.Figure()  # return an empty plot to prevent crashing
 
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col
-        ]
-        if matched_columns:
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            return go.Figure()
-    
-        mask = ft_sirius['compound_name'].apply(
-            lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
-            return go.Figure()
+    tables, ft_sirius = select_features(tables, ft_sirius, selected_features)
+    if tables is None:
+        return go.Figure()
     
     fig = make_subplots(
         rows=1,
@@ -755,63 +1802,19 @@ def process_and_plot_NPC_count(cleaned_data, metadata, ft_sirius, attribute_name
         specs=[[{'type': 'domain'}] * len(sample_locations)]
     )
 
-    for i, location in enumerate(sample_locations):
-        # Merge cleaned_data with metadata on 'filename'
-        cleaned_data_md = pd.merge(cleaned_data, metadata, on='filename')
-
-        # Filter the merged data based on the current sample location
-        cleaned_data_md_filtered = cleaned_data_md[cleaned_data_md[attribute_name] == location]
-
-        # Select columns that start with 'X'
-        cleaned_data_filtered_X = cleaned_data_md_filtered.loc[:, cleaned_data_md_filtered.columns.str.startswith('X')]
-
-        # Calculate row averages
-        row_averages = cleaned_data_filtered_X.T.mean(axis=1)
-
-        # Create a new DataFrame with the index and the averaged values
-        averaged_df = pd.DataFrame({
-            'compound_name': cleaned_data.T.index,
-            'average': row_averages
-        })
-
-        #Set the index of the new DataFrame
-        averaged_df.set_index('compound_name', inplace=True)
-
-        # Merge with ft_sirius on 'compound_name'
-        merged_sirius_data_T = pd.merge(ft_sirius, averaged_df, on='compound_name')
-        if filter_class:
-          merged_sirius_data_T = merged_sirius_data_T[merged_sirius_data_T['NPC#pathway'].isin(filter_class)]
-        if filter_prob:
-          merged_sirius_data_T = merged_sirius_data_T[merged_sirius_data_T['NPC#pathway Probability'] > filter_prob]
-          merged_sirius_data_T = merged_sirius_data_T[merged_sirius_data_T['NPC#superclass Probability'] > filter_prob]
-          merged_sirius_data_T = merged_sirius_data_T[merged_sirius_data_T['NPC#class Probability'] > filter_prob]
-        if filter_sirius:
-          merged_sirius_data_T = merged_sirius_data_T[merged_sirius_data_T['SiriusScoreNormalized'] > filter_sirius]
-        merged_sirius_data_T = merged_sirius_data_T.fillna('Unclassified')
-        # Copy and filter columns of interest
-        merged_sirius_data_T_copy = merged_sirius_data_T.copy()
+    # Filter each location, then build the hierarchies of all locations together
+    frames = []
+    for location, merged_sirius_data_T in filtered_locations(tables, ft_sirius, sample_locations, threshold,
+                                                             filter_class, filter_prob, filter_sirius,
+                                                             cutoff_after_filters=True):
+        # ft_sirius rows with the location's average intensity, from the group tables; the
+        # intensity cutoff is taken over the features passing the score filters
         col_interests =['NPC#pathway', 'NPC#superclass', 'NPC#class','average']
-        merged_sirius_data_T_copy = merged_sirius_data_T_copy[col_interests].fillna('Unclassified')
-       # merged_sirius_data_T_copy = merged_sirius_data_T_copy[merged_sirius_data_T['average'] > threshold]
-        
-         
-        cutoff_value = merged_sirius_data_T_copy['average'].quantile(1 - threshold)
-        merged_sirius_data_T_copy = merged_sirius_data_T_copy[merged_sirius_data_T_copy['average'] > cutoff_value]
-        
-         # Create a sunburst plot for the current sample location
-        sunburst = px.sunburst(
-            merged_sirius_data_T_copy,
-            path=['NPC#pathway', 'NPC#superclass', 'NPC#class'],
-            values=None
-        )
-
-        # Re-map each node's label to its color
-        for trace in sunburst.data:
-            labels = trace.labels
-            trace.marker.colors = [node_color_map.get(label, '#CCCCCC') for label in labels]
+        frames.append(merged_sirius_data_T[col_interests].fillna('Unclassified'))
 
-        for trace in sunburst.data:
-            fig.add_trace(trace, row=1, col=i+1)
+    # One sunburst per location, sized by the number of features
+    for i, trace in enumerate(sunburst_traces(frames, node_color_map)):
+        fig.add_trace(trace, row=1, col=i+1)
 
     # Update layout
     fig.update_layout(
@@ -839,7 +1842,7 @@ def process_and_plot_pca(
     filter_class,
     filter_prob,
     filter_sirius,
-    selected_compounds = None 
+    selected_features = None 
 ):
     import pandas as pd
     from sklearn.decomposition import PCA
@@ -850,36 +1853,20 @@ def process_and_plot_pca(
     if not sample_locations:
         return go.Figure()
 
-    if selected_compounds:
-        matched_columns = [
-            col for col in cleaned_data.columns
-            for name in selected_compounds
-            if name in col
-        ]
-        if matched_columns:
-            cleaned_data = cleaned_data[matched_columns]
-        else:
-            return go.Figure()
-    
-        mask = ft_sirius['compound_name'].apply(
-            lambda full_name: any(sel in full_name for sel in selected_compounds)
-        )
-        ft_sirius = ft_sirius[mask]
-        if ft_sirius.empty:
+    if selected_features is not None:
+        ft_sirius = ft_sirius.iloc[selected_features]
+        matched_columns = cleaned_data.columns.intersection(ft_sirius['feature_id'], sort=False)
+        if matched_columns.empty or ft_sirius.empty:
             return go.Figure()
+        cleaned_data = cleaned_data[matched_columns]
 
-    
-    # Merge peak and metadata
-    data = pd.merge(cleaned_data, metadata, on='filename')
-    data = convert_commas_to_floats(data)
-    ft_sirius = convert_commas_to_floats(ft_sirius)
-
-    # Filter by selected sample locations
-    data = data[data[attribute_name].isin(sample_locations)]
+    # Take the selected samples from the matrix (no merge with the metadata)
+    report_progress(0, 3, "Filtering features")
+    rows, sample_md = select_sample_rows(cleaned_data, metadata, attribute_name, sample_locations)
 
-    # Extract compound intensity columns
-    compound_cols = [col for col in data.columns if col.startswith("X")]
-    intensity_matrix = data[compound_cols].copy()
+    # Every column is a feature (integer id)
+    compound_cols = list(cleaned_data.columns)
+    intensity_matrix = cleaned_data.iloc[rows]
 
     # Handle negative/zero values (important for log-based data or scaling)
     if intensity_matrix.min().min() <= 0:
@@ -887,35 +1874,25 @@ def process_and_plot_pca(
 
     # Transpose to get per-compound averages for filtering
     compound_averages = intensity_matrix.mean(axis=0).reset_index()
-    compound_averages.columns = ['compound_name', 'average']
+    compound_averages.columns = ['feature_id', 'average']
 
     # Merge with annotation
-    merged = pd.merge(ft_sirius, compound_averages, on='compound_name', how='inner')
+    merged = pd.merge(ft_sirius, compound_averages, on='feature_id', how='inner')
 
     # Apply filtering logic
     cutoff = merged['average'].quantile(1 - threshold)
-    merged = merged[merged['average'] > cutoff]
+    keep = (merged['average'] > cutoff).to_numpy() & score_mask(merged, filter_class, filter_prob, filter_sirius)
+    merged = merged[keep]
 
-    if filter_class:
-        merged = merged[merged['NPC#pathway'].isin(filter_class)]
-    if filter_prob:
-        merged = merged[
-            (merged['NPC#pathway Probability'] > filter_prob) &
-            (merged['NPC#superclass Probability'] > filter_prob) &
-            (merged['NPC#class Probability'] > filter_prob)
-        ]
-    if filter_sirius:
-        merged = merged[merged['SiriusScoreNormalized'] > filter_sirius]
-
-    selected_compounds = merged['compound_name'].tolist()
-    selected_cols = [col for col in compound_cols if col in selected_compounds]
+    selected_ids = set(merged['feature_id'].tolist())
+    selected_cols = [col for col in compound_cols if col in selected_ids]
 
     if not selected_cols:
         return go.Figure()
 
     # Extract the final matrix and labels
     final_matrix = intensity_matrix[selected_cols]
-    labels = data[attribute_name].values
+    labels = sample_md[attribute_name].values
 
     if final_matrix.shape[0] < 2 or final_matrix.shape[1] < 2:
         return go.Figure(
@@ -928,12 +1905,16 @@ def process_and_plot_pca(
 
     
     # Scale the data
+    check_superseded()
+    report_progress(1, 3, "Computing PCA")
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(final_matrix)
 
     # Apply PCA
     pca = PCA(n_components=2)
     components = pca.fit_transform(X_scaled)
+    check_superseded()
+    report_progress(2, 3, "MANOVA and plot")
 
     # Create plot dataframe
     pca_df = pd.DataFrame({
@@ -973,9 +1954,10 @@ def process_and_plot_pca(
     
     # --- Heatmap (Feature contributions) ---
     loadings = np.dot(X_scaled.T, components)
+    labels_by_id = pd.Series(feature_labels(merged).values, index=merged['feature_id'].values)
     loadings_df = pd.DataFrame(
         loadings,
-        index=selected_cols,
+        index=labels_by_id.reindex(selected_cols).values,
         columns=[f'PC{i+1}' for i in range(components.shape[1])]
     )
     loadings_df = (loadings_df - loadings_df.mean()) / loadings_df.std()
@@ -1051,48 +2033,49 @@ def process_and_plot_rf(cleaned_data, metadata, ft_sirius,
     #if 'filename' not in cleaned_data.columns or 'filename' not in metadata.columns:
        # return px.scatter(title="Missing 'filename' column to merge cleaned data and metadata")
 
-    df = pd.merge(cleaned_data, metadata, on='filename')
-
-    # --- Only keep selected samples (if provided) ---
-    if sample_locations:
-        df = df[df[group_col].isin(sample_locations)]
-        if df.empty:
-            return px.scatter(title="No matching samples after filtering")
+    # --- Only keep selected samples (if provided), taken from the matrix by label ---
+    if not sample_locations:
+        sample_locations = metadata[group_col].dropna().unique()
+    rows, sample_md = select_sample_rows(cleaned_data, metadata, group_col, sample_locations)
+    if sample_md.empty:
+        return px.scatter(title="No matching samples after filtering")
 
     # --- Apply Sirius/Canopus filters ---
-    ft = ft_sirius.copy()
-
     #if filter_class:
     #    ft = ft[ft['NPC#superclass'].isin(filter_class) |
      #           ft['NPC#class'].isin(filter_class) |
      #           ft['NPC#pathway'].isin(filter_class)]
-    if filter_prob:
-        ft = ft[(ft['NPC#pathway Probability'] > filter_prob) &
-                (ft['NPC#superclass Probability'] > filter_prob) &
-                (ft['NPC#class Probability'] > filter_prob)]
-    if filter_sirius:
-        ft = ft[ft['SiriusScoreNormalized'] > filter_sirius]
+    ft = ft_sirius[score_mask(ft_sirius, filter_prob=filter_prob, filter_sirius=filter_sirius)]
 
     if ft.empty:
         return px.scatter(title="No features passed the filtering criteria")
 
     # --- Build feature matrix ---
-    # Assume compound intensities are columns "X..." and identified in ft_sirius["compound_name"]
-    feature_cols = [c for c in df.columns if c.startswith("X")]
-    X = df[feature_cols]
-    y = df[group_col]
+    # Every column is a feature, identified by ft_sirius["feature_id"]
+    feature_cols = list(cleaned_data.columns)
+    X = cleaned_data.iloc[rows]
+    y = sample_md[group_col]
 
     if y.nunique() < 2:
         return px.scatter(title="Need at least 2 groups for classification")
 
     # --- Train Random Forest ---
+    cv_dynamic = min(5, y.nunique())
+    n_fits = cv_dynamic + 1
+    check_superseded()
+    report_progress(0, n_fits, "Training Random Forest")
     rf = RandomForestClassifier(n_estimators=500, random_state=42, n_jobs=-1)
     rf.fit(X, y)
 
-    cv_dynamic = min(5, y.nunique())
-    
-    scores = cross_val_score(rf, X, y, cv=cv_dynamic)
-    acc = scores.mean()
+    # Same folds and scores as cross_val_score(rf, X, y, cv=cv_dynamic), one fit at a
+    # time so a superseded request stops between folds
+    scores = []
+    for i, (train, test) in enumerate(StratifiedKFold(n_splits=cv_dynamic).split(X, y)):
+        check_superseded()
+        report_progress(i + 1, n_fits, f"Cross-validation {i + 1}/{cv_dynamic}")
+        fold = clone(rf).fit(X.iloc[train], y.iloc[train])
+        scores.append(fold.score(X.iloc[test], y.iloc[test]))
+    acc = np.mean(scores)
 
     # --- Importances ---
     importances = pd.Series(rf.feature_importances_, index=feature_cols)
@@ -1100,12 +2083,14 @@ def process_and_plot_rf(cleaned_data, metadata, ft_sirius,
     feat_imp = (
         importances.to_frame('importance')
         .reset_index()
-        .rename(columns={'index': 'compound_id'})
-        .merge(ft, left_on='compound_id', right_on='compound_name', how='left')
+        .rename(columns={'index': 'feature_id'})
+        .merge(ft, on='feature_id', how='left')
         .sort_values('importance', ascending=False)
     )
 
-    top_feats = feat_imp.head(20)
+    top_feats = npc_labels(feat_imp.head(20))
+    # Display labels; ft_sirius rows are in feature id order
+    top_feats['compound_id'] = feature_labels(ft_sirius.iloc[top_feats['feature_id']]).values
 
     # --- Plot ---
     fig = px.bar(
@@ -1126,21 +2111,141 @@ def process_and_plot_rf(cleaned_data, metadata, ft_sirius,
     return fig
 
 
+# Feature map (RT x m/z). WebGL points up to SCATTER_MAX_POINTS visible features; beyond
+# that the visible window is binned on the server and sent as a heatmap, and zooming in
+# re-bins (or switches to points once few enough features are in view).
+SCATTER_MAX_POINTS = 50_000
+SCATTER_BINS = (300, 300)  # RT x m/z
+
+
+def view_range(relayout, axis):
+    """(min, max) of `axis` ('xaxis'/'yaxis') from dcc.Graph relayoutData, None if autoranged."""
+    if not relayout or relayout.get(f'{axis}.autorange'):
+        return None
+    if f'{axis}.range[0]' in relayout and f'{axis}.range[1]' in relayout:
+        return float(relayout[f'{axis}.range[0]']), float(relayout[f'{axis}.range[1]'])
+    if f'{axis}.range' in relayout:
+        low, high = relayout[f'{axis}.range']
+        return float(low), float(high)
+    return None
+
+
+def bin_features(x, y, x_range, y_range, bins=SCATTER_BINS):
+    """Counts of the (x, y) points on a bins grid over x_range x y_range, plus the bin centers."""
+    (x0, x1), (y0, y1) = x_range, y_range
+    nx, ny = bins
+    dx = (x1 - x0) / nx or 1.0
+    dy = (y1 - y0) / ny or 1.0
+    ix = np.clip(((x - x0) / dx).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((y - y0) / dy).astype(np.int64), 0, ny - 1)
+    counts = np.bincount(iy * nx + ix, minlength=nx * ny).reshape(ny, nx)
+    return x0 + (np.arange(nx) + 0.5) * dx, y0 + (np.arange(ny) + 0.5) * dy, counts
+
+
+def scatter_rt_mz(tables, ft_sirius, sample_locations, threshold, node_color_map,
+                  filter_class, filter_prob, filter_sirius, group_cols,
+                  selected_features=None, relayout=None):
+    """
+    RT x m/z map of the features kept by the threshold / score filters (averages over
+    the selected locations), colored by the first selected NPC level.
+
+    `relayout` is the zoom of the graph (dcc.Graph relayoutData) when the callback was
+    triggered by it. Returns None when nothing needs redrawing: every feature is
+    already drawn as a point and the browser zooms on its own.
+    """
+    merged = filter_merged_dataset(tables, ft_sirius, sample_locations, threshold,
+                                   filter_class, filter_prob, filter_sirius, selected_features)
+    if merged.empty:
+        return go.Figure()
+    if relayout is not None and len(merged) <= SCATTER_MAX_POINTS:
+        return None
+
+    level = group_cols[0] if group_cols else 'NPC#pathway'
+    rt = merged['rt'].to_numpy(dtype=np.float64)
+    mz = merged['mz'].to_numpy(dtype=np.float64)
+    x_range = view_range(relayout, 'xaxis') or (rt.min(), rt.max())
+    y_range = view_range(relayout, 'yaxis') or (mz.min(), mz.max())
+    visible = (rt >= x_range[0]) & (rt <= x_range[1]) & (mz >= y_range[0]) & (mz <= y_range[1])
+
+    fig = go.Figure()
+    if visible.sum() <= SCATTER_MAX_POINTS:
+        shown = merged[visible]
+        # Labels from the registry rows (merged went through fillna); ft_sirius is in id order
+        labels = feature_labels(ft_sirius.iloc[shown['feature_id']]).to_numpy()
+        for value, positions in shown.groupby(level, sort=True, observed=True).indices.items():
+            fig.add_trace(go.Scattergl(
+                x=rt[visible][positions],
+                y=mz[visible][positions],
+                mode='markers',
+                name=str(value),
+                marker=dict(size=5, opacity=0.7, color=node_color_map.get(value, '#CCCCCC')),
+                text=labels[positions],
+                hovertemplate="%{text}<br>RT %{x:.3f} min<br>m/z %{y:.4f}<extra></extra>",
+            ))
+        title = f"{int(visible.sum())} features"
+    else:
+        x_centers, y_centers, counts = bin_features(rt[visible], mz[visible], x_range, y_range)
+        fig.add_trace(go.Heatmap(
+            x=x_centers,
+            y=y_centers,
+            z=np.where(counts > 0, counts, np.nan),  # empty bins stay transparent
+            colorscale='Plasma',
+            colorbar=dict(title="Features"),
+            hovertemplate="RT %{x:.2f} min<br>m/z %{y:.3f}<br>%{z} features<extra></extra>",
+        ))
+        title = f"{int(visible.sum())} features, binned (zoom in to see individual features)"
+
+    fig.update_layout(
+        title_text=f"Feature map: {title}",
+        template="plotly_white",
+        height=700,
+        legend_title_text=level,
+    )
+    fig.update_xaxes(title_text="RT (min)", range=list(x_range) if relayout is not None else None)
+    fig.update_yaxes(title_text="m/z", range=list(y_range) if relayout is not None else None)
+    return fig
+
+
 # In[35]:
 
 
-def generate_node_level_color_map(ft_sirius):
+NPC_LEVELS = ['NPC#pathway', 'NPC#superclass', 'NPC#class']
+
+# Create a mapping for aliases / typo corrections
+NPC_ALIASES = {
+    "Sphingolipids": "Spingolipids",
+    "GlycoLipids": "Glycolipids",
+    # Add more mappings here as needed
+}
 
-        # Create a mapping for aliases / typo corrections
-    alias_map = {
-        "Sphingolipids": "Spingolipids",
-        "GlycoLipids": "Glycolipids",
-        # Add more mappings here as needed
-    }
 
-    # Apply alias mapping to relevant columns
-    for col in ['NPC#pathway', 'NPC#superclass', 'NPC#class']:
-        ft_sirius[col] = ft_sirius[col].replace(alias_map)
+def prepare_annotations(ft_sirius):
+    """
+    Normalize the CANOPUS/SIRIUS annotations once, at ingest: decimal commas parsed, scores
+    and probabilities as float32, and the NPC levels (aliases applied) as categoricals
+    whose categories include 'Unclassified', so the plots can fillna with it.
+    """
+    # The registry fields (names, PubChem ids) are text even when they look numeric
+    annotation_cols = ft_sirius.columns.difference(FEATURE_FIELDS, sort=False)
+    ft_sirius[annotation_cols] = convert_commas_to_floats(ft_sirius[annotation_cols].copy())
+
+    score_cols = [col for col in ft_sirius.columns
+                  if col.endswith('Probability') or col == 'SiriusScoreNormalized']
+    ft_sirius[score_cols] = ft_sirius[score_cols].astype(np.float32)
+
+    for col in NPC_LEVELS:
+        values = ft_sirius[col].replace(NPC_ALIASES)
+        categories = sorted(set(values.dropna().astype(str)) | {'Unclassified'})
+        ft_sirius[col] = pd.Categorical(values, categories=categories)
+    return ft_sirius
+
+
+def npc_labels(df):
+    """NPC levels back as plain labels; plotly express would draw every category, used or not."""
+    return df.astype({col: object for col in NPC_LEVELS if col in df.columns})
+
+
+def generate_node_level_color_map(ft_sirius):
     # Combine all unique labels
     pathways = ft_sirius['NPC#pathway'].fillna('Unclassified').unique()
     superclasses = ft_sirius['NPC#superclass'].fillna('Unclassified').unique()
@@ -1158,20 +2263,20 @@ def generate_node_level_color_map(ft_sirius):
 # In[36]:
 
 
-def parse_contents(contents,trim=False):
-
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
-    decoded_str = decoded.decode('utf-8')
+def parse_upload(upload, trim=False):
+    """Parse a file streamed to UPLOAD_DIR; `upload` is the handle stored by the browser."""
+    path = upload_file_path(upload['upload_id'])
 
     # Try to detect if it's TSV or CSV based on first line
-    first_line = decoded_str.splitlines()[0]
+    with open(path, encoding='utf-8', newline='') as fh:
+        first_line = fh.readline()
     delimiter = '\t' if '\t' in first_line else ','
 
+    # pandas reads straight from the file: one copy of the data, as the parsed frame
     if trim:
-        df = pd.read_csv(io.StringIO(decoded_str), delimiter=delimiter,skiprows=4)
+        df = pd.read_csv(path, delimiter=delimiter, skiprows=4)
     else:
-        df = pd.read_csv(io.StringIO(decoded_str), delimiter=delimiter)
+        df = pd.read_csv(path, delimiter=delimiter)
     
     df.reset_index(drop=True, inplace=True)
     print("Index name:", df.index.name)
@@ -1188,22 +2293,298 @@ jupyter_dash.default_mode="external"
 
 external_stylesheets = [dbc.themes.FLATLY]
 
-app = Dash(__name__, external_stylesheets=external_stylesheets,suppress_callback_exceptions=True)
+# ---- Background jobs ----
+# Loading files, the preprocessing steps, PCA and the Random Forest run as background
+# callbacks: DiskcacheManager starts one worker process per job and keeps the job table,
+# progress and results in a diskcache under JOB_DIR (no broker). The browser polls the
+# job, shows its progress and can cancel it, which kills the process; stages are written
+# atomically, so a cancelled job never leaves a partial stage behind.
+JOB_DIR = os.path.join("dash_cache", "jobs")
+JOB_POLL_MS = 500
+
+job_cache = diskcache.Cache(JOB_DIR)
+background_manager = DiskcacheManager(job_cache)
+
+app = Dash(__name__, external_stylesheets=external_stylesheets,suppress_callback_exceptions=True,
+           background_callback_manager=background_manager)
+
+# Heavy stages live on disk under STAGE_DIR (see cache_put / matrix_put)
+os.makedirs(STAGE_DIR, exist_ok=True)
+
+
+# ---- Streaming uploads ----
+# assets/chunked_upload.js sends each file in chunks to these routes, so large
+# exports are written straight to disk and never pass through a callback as base64.
+# An interrupted upload resumes from the size reported by GET /upload/<id>.
+# Each chunk declares the size of the whole file; files over UPLOAD_MAX_BYTES, chunks
+# over UPLOAD_CHUNK_MAX_BYTES and more than UPLOAD_MAX_FILES pending uploads are refused.
+# An upload is deleted once it is loaded into stages, or after UPLOAD_TTL if it never is.
+UPLOAD_DIR = os.path.join("dash_cache", "uploads")
+UPLOAD_READ_SIZE = 1024 * 1024
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+UPLOAD_MAX_BYTES = int(os.environ.get("CANVAS_UPLOAD_MAX_BYTES", 4 * 1024 ** 3))
+UPLOAD_CHUNK_MAX_BYTES = 16 * 1024 * 1024  # the browser sends 8 MB chunks
+UPLOAD_MAX_FILES = 64
+UPLOAD_TTL = 24 * 3600  # seconds
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+
+def upload_file_path(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id or ''):
+        raise ValueError(f"Invalid upload id: {upload_id!r}")
+    return os.path.join(UPLOAD_DIR, upload_id + ".upload")
+
+
+def expire_uploads():
+    """Delete uploads untouched for UPLOAD_TTL (abandoned, or never loaded); returns how many are left."""
+    cutoff = time.time() - UPLOAD_TTL
+    left = 0
+    for entry in os.scandir(UPLOAD_DIR):
+        if not entry.name.endswith(".upload"):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+            else:
+                left += 1
+        except OSError:  # removed meanwhile by another worker
+            pass
+    return left
+
 
-# Create the cache object first
-cache = Cache()
+def remove_uploads(*uploads):
+    """Delete the files of upload handles whose content is now in stages."""
+    for upload in uploads:
+        if not upload:
+            continue
+        try:
+            os.remove(upload_file_path(upload['upload_id']))
+        except (OSError, ValueError):
+            pass
 
 
-# Then initialize it with the underlying Flask server
-cache.init_app(
-    app.server,
-    config={
-        "CACHE_TYPE": "filesystem",   # or "simple" for in-memory
-        "CACHE_DIR": "dash_cache",    # required for filesystem
-        "threshold": 500,             # max entries
-        "default_timeout": 24*3600,   # 1 day
-    }
-)
+def uploads_present(*uploads):
+    return all(os.path.exists(upload_file_path(upload['upload_id'])) for upload in uploads if upload)
+
+
+@app.server.route("/upload/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    try:
+        path = upload_file_path(upload_id)
+    except ValueError:
+        abort(400)
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    return jsonify(received=received)
+
+
+@app.server.route("/upload/<upload_id>", methods=["POST"])
+def upload_chunk(upload_id):
+    try:
+        path = upload_file_path(upload_id)
+    except ValueError:
+        abort(400)
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    offset = request.args.get("offset", default=0, type=int)
+    size = request.args.get("size", type=int)
+    length = request.content_length
+    if size is None:
+        return jsonify(received=received, error="Missing file size."), 400
+    if not 0 <= size <= UPLOAD_MAX_BYTES:
+        return jsonify(received=received, error=f"Files are limited to {UPLOAD_MAX_BYTES // 1024 ** 2} MB."), 413
+    if length is None:
+        return jsonify(received=received, error="Missing chunk length."), 411
+    if length > UPLOAD_CHUNK_MAX_BYTES:
+        return jsonify(received=received, error="Chunk too large."), 413
+    if offset != received:
+        # Client is out of sync (e.g. a retried chunk already landed): tell it where to go on
+        return jsonify(received=received), 409
+    if offset + length > size:
+        return jsonify(received=received, error="Chunk past the declared file size."), 400
+    if received == 0 and expire_uploads() >= UPLOAD_MAX_FILES:
+        return jsonify(received=received, error="Too many pending uploads, try again later."), 429
+
+    with open(path, "ab") as fh:
+        while True:
+            block = request.stream.read(UPLOAD_READ_SIZE)
+            if not block:
+                break
+            fh.write(block)
+        received = fh.tell()
+    return jsonify(received=received)
+
+
+@app.server.route("/upload/<upload_id>/complete", methods=["POST"])
+def upload_complete(upload_id):
+    try:
+        path = upload_file_path(upload_id)
+    except ValueError:
+        abort(400)
+    if not os.path.exists(path):
+        abort(404)
+
+    # The digest is what stage keys are built from (see handle_file_upload)
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(UPLOAD_READ_SIZE), b""):
+            digest.update(block)
+    return jsonify(upload_id=upload_id, size=os.path.getsize(path), sha1=digest.hexdigest())
+
+
+def upload_zone(zone_id, accept):
+    """Drop zone handled by assets/chunked_upload.js; the result lands in store-<zone_id>."""
+    return html.Div(
+        [
+            html.Div(['Drag and Drop or ', html.A('Select File')]),
+            html.Small(id=f'{zone_id}-progress', className='text-muted'),
+        ],
+        id=zone_id,
+        className='chunked-upload',
+        style={'border': '1px dashed #aaa', 'padding': '10px', 'cursor': 'pointer'},
+        **{'data-store': f'store-{zone_id}', 'data-accept': accept},
+    )
+
+
+# ---- Figure cache ----
+# Tab figures keyed by everything they depend on (the selection key includes the stage
+# key, a content hash), kept as serialized JSON and evicted least-recently-used once the
+# byte budget is exceeded. Per worker process; GET /stats/figure-cache reports the
+# counters used to size FIGURE_CACHE_BYTES. Figures built in background jobs (processes
+# that exit with the job) are shared through the job cache instead, for FIGURE_SHARED_TTL;
+# their counters live in the job cache too (diskcache incr is atomic across processes)
+# and are reported under "shared".
+FIGURE_CACHE_BYTES = int(os.environ.get("CANVAS_FIGURE_CACHE_BYTES", 128 * 1024 * 1024))
+FIGURE_SHARED_TTL = 3600  # seconds
+figure_cache = OrderedDict()  # key -> figure JSON
+figure_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+figure_cache_lock = threading.Lock()
+FIGURE_SHARED_STATS = ("hits", "misses", "stores", "skipped")
+
+
+def figure_cache_get(key, shared=False):
+    """Figure dict for `key`, or None on a miss. `shared` looks in the job cache instead."""
+    if shared:
+        figure_json = job_cache.get(("figure", key))
+        job_cache.incr(("figure-stats", "misses" if figure_json is None else "hits"))
+        return json.loads(figure_json) if figure_json is not None else None
+    with figure_cache_lock:
+        figure_json = figure_cache.get(key)
+        if figure_json is None:
+            figure_cache_stats["misses"] += 1
+            return None
+        figure_cache.move_to_end(key)
+        figure_cache_stats["hits"] += 1
+    return json.loads(figure_json)
+
+
+def figure_cache_put(key, fig, shared=False):
+    figure_json = fig.to_json() if hasattr(fig, "to_json") else json.dumps(fig)
+    size = len(figure_json)
+    if size > FIGURE_CACHE_BYTES:
+        if shared:
+            job_cache.incr(("figure-stats", "skipped"))
+        return
+    if shared:
+        job_cache.set(("figure", key), figure_json, expire=FIGURE_SHARED_TTL)
+        job_cache.incr(("figure-stats", "stores"))
+        return
+    with figure_cache_lock:
+        old = figure_cache.pop(key, None)
+        if old is not None:
+            figure_cache_stats["bytes"] -= len(old)
+        figure_cache[key] = figure_json
+        figure_cache_stats["bytes"] += size
+        while figure_cache_stats["bytes"] > FIGURE_CACHE_BYTES:
+            _, evicted = figure_cache.popitem(last=False)
+            figure_cache_stats["bytes"] -= len(evicted)
+            figure_cache_stats["evictions"] += 1
+
+
+@app.server.route("/stats/figure-cache", methods=["GET"])
+def figure_cache_status():
+    # Expired shared figures are dropped by diskcache itself, so there is no eviction count
+    shared = {name: job_cache.get(("figure-stats", name), 0) for name in FIGURE_SHARED_STATS}
+    shared.update(ttl=FIGURE_SHARED_TTL, disk_bytes=job_cache.volume())
+    with figure_cache_lock:
+        return jsonify(entries=len(figure_cache), budget=FIGURE_CACHE_BYTES, shared=shared,
+                       **figure_cache_stats)
+
+
+# ---- Superseded requests ----
+# Dragging a slider or typing fires one request per value, and each would run to the end.
+# A figure callback takes a generation for its (session, output) when it starts, a file
+# under REQUEST_DIR so every worker sees it, and checks it between stages: once a newer
+# request for the same output has started the older one stops (no update), so the
+# browser keeps its figure until the latest request lands. Generation files untouched
+# for REQUEST_TTL (closed sessions) are deleted whenever a new one is created.
+REQUEST_DIR = os.path.join("dash_cache", "requests")
+REQUEST_TTL = 24 * 3600  # seconds
+_request = threading.local()  # generation (and job progress) of the running request
+
+
+def prune_requests():
+    cutoff = time.time() - REQUEST_TTL
+    for entry in os.scandir(REQUEST_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:  # removed meanwhile by another worker
+            pass
+
+
+class Superseded(PreventUpdate):
+    """A newer request for the same output has started."""
+
+
+@contextmanager
+def latest_request(session_id, output):
+    path = os.path.join(REQUEST_DIR, f"{session_id or 'shared'}_{output}")
+    if not os.path.exists(path):  # new session (or output): drop the expired ones
+        os.makedirs(REQUEST_DIR, exist_ok=True)
+        prune_requests()
+    generation = time.time_ns()
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(str(generation))
+    os.replace(tmp_path, path)
+    previous = getattr(_request, "token", None)
+    _request.token = (path, generation)
+    try:
+        yield
+    finally:
+        _request.token = previous
+
+
+def check_superseded():
+    """Raise Superseded if a newer request for the running callback's output has started."""
+    token = getattr(_request, "token", None)
+    if token is None:  # not inside latest_request
+        return
+    path, generation = token
+    try:
+        with open(path) as fh:
+            latest = int(fh.read())
+    except (OSError, ValueError):
+        return
+    if latest > generation:
+        raise Superseded()
+
+
+@contextmanager
+def job_progress(set_progress):
+    """Route report_progress to a background callback's set_progress while inside."""
+    previous = getattr(_request, "progress", None)
+    _request.progress = set_progress
+    try:
+        yield
+    finally:
+        _request.progress = previous
+
+
+def report_progress(done, total, label):
+    """Progress bar of the running background job at done / total; no-op outside a job."""
+    set_progress = getattr(_request, "progress", None)
+    if set_progress is not None:
+        set_progress((int(100 * done / max(total, 1)), label))
 
 
 selection_card = dbc.Card(
@@ -1374,10 +2755,11 @@ compound_selection_card = dbc.Card(
             ),
             html.Div(  # this div wraps the searchable UI and starts hidden
                 [
-                    dbc.Label("Search compound name"),
+                    dbc.Label("Search compound name, PubChem ID or m/z"),
                     dcc.Input(
                         id='compound-search-input', 
                         type='text',
+                        debounce=0.3,  # search once typing pauses, not on every key
                         placeholder='Type part of compound name...'
                     ),
                     dcc.Dropdown(
@@ -1390,26 +2772,96 @@ compound_selection_card = dbc.Card(
                 ],
                 id="compound-search-controls",
                 style={"display": "none"}  # hidden by default
-            )
+            ),
+
+            dbc.Label("m/z (± ppm) and RT (min) window", className="mt-3"),
+            dbc.Row([
+                dbc.Col(dcc.Input(id='mz-target-input', type='number', placeholder='m/z',
+                                  debounce=True, style={"width": "100%"}), width=5),
+                dbc.Col(dcc.Input(id='mz-ppm-input', type='number', min=0, value=MZ_TOLERANCE_PPM,
+                                  debounce=True, style={"width": "100%"}), width=3),
+            ], className="g-1"),
+            dbc.Row([
+                dbc.Col(dcc.Input(id='rt-min-input', type='number', placeholder='RT from',
+                                  debounce=True, style={"width": "100%"}), width=4),
+                dbc.Col(dcc.Input(id='rt-max-input', type='number', placeholder='RT to',
+                                  debounce=True, style={"width": "100%"}), width=4),
+            ], className="g-1 mt-1"),
         ])
     )
  
 
 
 
+# --- Plot tabs: one graph per tab, each filled by its own callback
+
+JOB_HIDDEN = {'display': 'none'}
+JOB_SHOWN = {'display': 'flex', 'alignItems': 'center', 'gap': '0.5rem'}
+
+
+def job_panel(job_id):
+    """Progress bar and cancel button of a background job, shown while it runs."""
+    return html.Div([
+        dbc.Progress(id=f'progress-{job_id}', value=0, striped=True, animated=True,
+                     style={'flex': 1, 'height': '1.5rem'}),
+        dbc.Button("Cancel", id=f'cancel-{job_id}', color="secondary", outline=True, size="sm"),
+    ], id=f'job-{job_id}', style=JOB_HIDDEN, className="my-2")
+
+
+def job_options(job_id, *running):
+    """Callback arguments running it as a background job reporting to job_panel(job_id)."""
+    return dict(
+        background=True,
+        interval=JOB_POLL_MS,
+        progress=[Output(f'progress-{job_id}', 'value'), Output(f'progress-{job_id}', 'label')],
+        progress_default=[0, ""],
+        running=[(Output(f'job-{job_id}', 'style'), JOB_SHOWN, JOB_HIDDEN), *running],
+        cancel=[Input(f'cancel-{job_id}', 'n_clicks')],
+    )
+
+
+def tab_graph(tab_id, job=False):
+    graph = dbc.Spinner(
+        dcc.Graph(id=f'graph-{tab_id}',
+                 config={
+        "toImageButtonOptions": {
+            "format": "svg",  # one of png, svg, jpeg, webp
+            "filename": "my_plot",
+            "height": 600,
+            "width": 800,
+            "scale": 1
+        }}),
+        color="primary",  # 'primary', 'secondary', 'success', etc.
+        type="border",    # or 'grow'
+        fullscreen=False,  # You can set to True for full-page overlay
+        size="md",        # 'sm', 'md', 'lg'
+        spinner_style={"width": "3rem", "height": "3rem"}  # optional custom style
+    )
+    # Tabs computed in background jobs show their progress above the graph
+    return html.Div([job_panel(tab_id), graph]) if job else graph
+
+
 app.layout = dbc.Container([
 
 
+    dcc.Store(id='session-id'),          # per-tab id, scopes group tables and requests
+    dcc.Store(id='store-upload-peak-areas'),   # {upload_id, filename, size, sha1}
+    dcc.Store(id='store-upload-metadata'),
+    dcc.Store(id='store-upload-canopus'),
+    dcc.Store(id='store-upload-structure'),
     dcc.Store(id='store-peak-areas'),
-    dcc.Store(id='store-metadata'),
-    dcc.Store(id='store-canopus'),
+    dcc.Store(id='store-metadata'),      # stage key of the metadata table (Parquet, server-side)
+    dcc.Store(id='store-canopus'),       # stage key of the CANOPUS table (Parquet, server-side)
     dcc.Store(id="radio-mode-store", data="Intensity"),
     dcc.Store(id='store-blanked'),       # after blank subtraction
     dcc.Store(id='store-imputed'),       # after imputation
     dcc.Store(id='store-normalized'),    # after normalization
     dcc.Store(id='store-scaled'),        # after scaling
     dcc.Store(id="store-current-step"),
-    dcc.Store(id='store-compound-names'),
+    dcc.Store(id='store-selection'),     # selection parameters shared by the summary and tab figures
+    dcc.Store(id='store-job-PCA'),       # selection + settings of the PCA / RF background jobs
+    dcc.Store(id='store-job-rf'),
+    dcc.Store(id='store-compound-names'),  # stage keys the compound search index is built from
     
     dbc.Row([
         html.H2("Sirius-Canopus visualization of LC-MS data")
@@ -1421,43 +2873,19 @@ app.layout = dbc.Container([
         dbc.Row([
             dbc.Col([
                 html.H5("Upload Peak Areas"),
-                dcc.Upload(
-                    id='upload-peak-areas',
-                    children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                    multiple=False,
-                    accept='.csv',
-                    style={'border': '1px dashed #aaa', 'padding': '10px'}
-                ),
+                upload_zone('upload-peak-areas', '.csv'),
             ]),
             dbc.Col([
                 html.H5("Upload Metadata"),
-                dcc.Upload(
-                    id='upload-metadata',
-                    children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                    multiple=False,
-                    accept='.csv',
-                    style={'border': '1px dashed #aaa', 'padding': '10px'}
-                ),
+                upload_zone('upload-metadata', '.csv'),
             ]),
             dbc.Col([
                 html.H5("Upload CANOPUS"),
-                dcc.Upload(
-                    id='upload-canopus',
-                    children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                    multiple=False,
-                    accept= '.csv,.tsv',
-                    style={'border': '1px dashed #aaa', 'padding': '10px'}
-                ),
+                upload_zone('upload-canopus', '.csv,.tsv'),
             ]),
             dbc.Col([
                 html.H5("Upload SIRIUS structure"),
-                dcc.Upload(
-                    id='upload-structure',
-                    children=html.Div(['Drag and Drop or ', html.A('Select File')]),
-                    multiple=False,
-                    accept= '.csv,.tsv',
-                    style={'border': '1px dashed #aaa', 'padding': '10px'}
-                ),
+                upload_zone('upload-structure', '.csv,.tsv'),
             ]),            
             
             dbc.Col([
@@ -1497,11 +2925,22 @@ app.layout = dbc.Container([
                                     dbc.Label("Blank Threshold:", className="mt-2"),
                                     dcc.Slider(
                                             id='blank-slider',
-                                            min=0, max=1, step=0.01, value=0.1, marks=None,
+                                            min=0, max=1, step=0.01, value=BLANK_CUTOFF, marks=None,
                                             tooltip={"placement": "bottom", "always_visible": True}
                                         
                                         )], width=3
                                        ),
+
+                                dbc.Col([
+                                    dbc.Label("Imputation:", className="mt-2"),
+                                    dcc.Dropdown(
+                                        id='imputation-strategy',
+                                        options=[{'label': label, 'value': value}
+                                                 for value, label in IMPUTATION_STRATEGIES.items()],
+                                        value='lod',
+                                        clearable=False,
+                                    )], width=3
+                                ),
                                 
                                  dbc.Col(
                                     dbc.ButtonGroup([
@@ -1509,9 +2948,10 @@ app.layout = dbc.Container([
                                         dbc.Button("Imputed", id="btn-imputed", color="success", outline=False, className="me-1", disabled=True),
                                         dbc.Button("Normalized", id="btn-normalized", color="info", outline=False, className="me-1", disabled=True),
                                         dbc.Button("Scaled", id="btn-scaled", color="warning", outline=False, className="me-1",disabled=True),
+                                        dbc.Button("All steps", id="btn-run-all", color="secondary", outline=False, className="me-1"),
                                     ],
                                     size="lg"),
-                                    width=9,
+                                    width=6,
                                     className="d-flex align-items-center justify-content-center"
                                 )
                             ])
@@ -1530,10 +2970,7 @@ app.layout = dbc.Container([
             width="auto"
             ),
             dbc.Col(
-            dcc.Loading(
-            html.Div("", id="loading-display-output"),
-            id="loading-display"
-        ),   
+            job_panel('load'),
             ),
             dbc.Col(
             html.Div(id="upload-status"),
@@ -1555,7 +2992,8 @@ app.layout = dbc.Container([
             html.Div(id="upload-status-scaling"),
             width=True  # Automatically takes remaining space
         ),
-        ], align="center", className="mb-3")
+        ], align="center", className="mb-3"),
+        job_panel('pipeline'),
     ], id="upload-panel", is_open=False),
 
 
@@ -1580,29 +3018,13 @@ app.layout = dbc.Container([
         id='tabs-final-plot',
         active_tab='sunburst',
         children=[
-            dbc.Tab(label='Sunburst Plot', tab_id='sunburst'),
-            dbc.Tab(label='Barplot', tab_id='barplot'),
-            dbc.Tab(label='PCA', tab_id = 'PCA'),
-            dbc.Tab(label='line_plot', tab_id = 'line_plot'),
-            dbc.Tab(label='Random Forest', tab_id='rf'),
+            dbc.Tab(tab_graph('sunburst'), label='Sunburst Plot', tab_id='sunburst'),
+            dbc.Tab(tab_graph('barplot'), label='Barplot', tab_id='barplot'),
+            dbc.Tab(tab_graph('PCA', job=True), label='PCA', tab_id = 'PCA'),
+            dbc.Tab(tab_graph('line_plot'), label='line_plot', tab_id = 'line_plot'),
+            dbc.Tab(tab_graph('rf', job=True), label='Random Forest', tab_id='rf'),
+            dbc.Tab(tab_graph('RT_mz'), label='RT / m/z map', tab_id='RT_mz'),
     ]),
-
-    dbc.Spinner(
-        dcc.Graph(id='final-graph',
-                 config={
-        "toImageButtonOptions": {
-            "format": "svg",  # one of png, svg, jpeg, webp
-            "filename": "my_plot",
-            "height": 600,
-            "width": 800,
-            "scale": 1
-        }}),
-        color="primary",  # 'primary', 'secondary', 'success', etc.
-        type="border",    # or 'grow'
-        fullscreen=False,  # You can set to True for full-page overlay
-        size="md",        # 'sm', 'md', 'lg'
-        spinner_style={"width": "3rem", "height": "3rem"}  # optional custom style
-    ),
     
     dbc.Row([
         html.H4("Data Preview"),
@@ -1627,41 +3049,165 @@ app.layout = dbc.Container([
 
 
 @callback(
-    Output("data-summary-toast", "children"),
-    Output("data-summary-toast", "is_open"),
-    Output('final-graph', 'figure'),
-    Input('tabs-final-plot', 'active_tab'),
+    Output('session-id', 'data'),
+    Input('session-id', 'data'),
+)
+def init_session(session_id):
+    # One id per page load: it scopes the group tables and request generations of the
+    # page, while stages of uploaded content are shared (see make_stage_key)
+    if session_id:
+        return no_update
+    return uuid4().hex
+
+
+# ---- Selection, summary and tab figures ----
+# The sample / compound selection is resolved once (update_selection only collects its
+# parameters into store-selection; selection_context turns them into group tables,
+# annotations and feature ids, cached per worker). The summary toast and each tab's figure
+# are separate callbacks on that store plus only the controls they use, and a tab's
+# callback does nothing while another tab is shown.
+SelectionContext = namedtuple("SelectionContext", [
+    "stage", "tables", "ft_sirius", "node_color_map", "selected_features",
+    "feature_cols", "sample_rows", "sample_metadata",
+])
+
+
+def selection_context(selection):
+    """SelectionContext of a store-selection value, built on first use, or None."""
+    if not selection or not matrix_has(selection['stage']) or not cache_has(selection['canopus']):
+        return None
+    samples = metadata_index(selection['metadata'])
+    if samples is None or selection['param'] not in samples.levels:
+        return None
+
+    def build():
+        # Annotations are typed at ingest, one row per feature id, in id order; read once
+        # and shared (read-only) by every selection on them
+        canopus_key = selection['canopus']
+        ft_sirius, node_color_map = cached_index(('annotations', canopus_key), lambda: annotations_get(canopus_key))
+        stage = matrix_get(selection['stage'])  # <-- memory-mapped, shared by all workers
+
+        # Secondary selection, as a mask over the samples
+        in_selection = None
+        if selection['second_param'] and selection['samples2']:
+            in_selection = sample_mask(samples, selection['second_param'], selection['samples2'])
+
+        # Group x feature averages for the selected attribute, shared by the summary and
+        # the sunburst / barplot / box plot tabs
+        tables = group_tables(selection['session'], selection['stage'], stage,
+                              sample_labels(samples, selection['param'], stage.samples, in_selection),
+                              selection['param'])
+        check_superseded()
+
+        # Selected compounds and m/z - RT window -> feature ids
+        selected_features = resolve_selection(feature_name_index(canopus_key, ft_sirius), selection['compounds'])
+        if selection['target_mz'] or selection['rt_min'] is not None or selection['rt_max'] is not None:
+            ppm = selection['ppm'] if selection['ppm'] is not None else MZ_TOLERANCE_PPM
+            in_window = query_mz_rt(mz_rt_index(canopus_key, ft_sirius), selection['target_mz'] or None,
+                                    ppm, selection['rt_min'], selection['rt_max'])
+            selected_features = in_window if selected_features is None else np.intersect1d(selected_features, in_window)
+        feature_cols = None
+        if selected_features is not None:
+            feature_cols = pd.Index(stage.features).intersection(selected_features, sort=False).tolist()
+
+        # Selected samples: the levels of the primary attribute AND the secondary selection.
+        # PCA / RF only need the primary attribute of these samples
+        selected_samples = sample_mask(samples, selection['param'], selection['locations'])
+        if in_selection is not None:
+            selected_samples &= in_selection
+        sample_rows = samples.samples[selected_samples]
+        sample_metadata = sample_labels(samples, selection['param'], sample_rows).to_frame()
+        sample_metadata.index.name = 'filename'
+
+        return SelectionContext(stage, tables, ft_sirius, node_color_map, selected_features,
+                                feature_cols, sample_rows, sample_metadata)
+
+    return cached_index(('selection', selection['key']), build)
+
+
+def sample_data(context, columns=None):
+    # PCA / RF work on the individual samples: only the selected samples (and
+    # compounds) are read from the stage file
+    cleaned_data = matrix_frame(context.stage, rows=context.sample_rows, columns=columns)
+    cleaned_data.index.name = 'filename'
+    return cleaned_data
+
+
+def tab_figure(tab, active_tab, selection, settings, plot):
+    """Figure of `tab` (see build_figure); no_update while another tab is shown."""
+    if active_tab != tab:
+        return no_update
+    return build_figure(tab, selection, settings, plot)
+
+
+def tab_job(tab, active_tab, queued, selection, *settings):
+    """
+    New value of store-job-<tab>, the input of a tab computed in a background job: set
+    only while the tab is shown and when the selection or settings differ from the
+    `queued` job, so hidden tabs and tab switches start no job.
+    """
+    if active_tab != tab:
+        return no_update
+    job = {'selection': selection, 'settings': list(settings)}
+    return no_update if job == queued else job
+
+
+def build_figure(tab, selection, settings, plot, shared=False):
+    """
+    Figure of `tab` for the selection and `settings` (the other inputs it depends on):
+    from the figure cache when already built, else plot(context). An empty figure when
+    the selection is incomplete; no update when a newer request for the tab has started
+    meanwhile. `shared` keeps the figure in the job cache (for tabs computed in
+    background jobs).
+    """
+    if not selection:
+        return go.Figure()
+
+    # A figure already built for this selection and these settings comes from the cache
+    # (the selection key includes the stage key, a content hash of the uploads and
+    # processing steps)
+    figure_key = content_hash(selection['key'], tab, *settings)
+    cached = figure_cache_get(figure_key, shared)
+    if cached is not None:
+        return cached
+
+    # Stops (no update) at the next stage once a newer request for this tab has started
+    with latest_request(selection['session'], tab):
+        context = selection_context(selection)
+        if context is None:
+            return go.Figure()
+        check_superseded()
+        fig = plot(context)
+        if fig is None:  # nothing to redraw
+            return no_update
+        # Finished work is kept even when it is no longer wanted
+        figure_cache_put(figure_key, fig, shared)
+        check_superseded()
+    return fig
+
+
+@callback(
+    Output('store-selection', 'data'),
     Input('parameter-dropdown', 'value'),
     Input('parameter-dropdown2', 'value'),  
     Input('information-dropdown', 'value'),
     Input('information-dropdown2', 'value'),
-    Input('threshold-slider', 'value'),
-    Input('probability-slider', 'value'),
-    Input('sirius-slider', 'value'),
-    Input('radio-mode-store', 'data'),
-    Input('checkbox-levels', 'value'),
     Input("store-current-step", "data"),    # <-- key, not big JSON
     Input("compound_dropdown", "value"),
+    Input('mz-target-input', 'value'),
+    Input('mz-ppm-input', 'value'),
+    Input('rt-min-input', 'value'),
+    Input('rt-max-input', 'value'),
     State('store-metadata', 'data'),
     State('store-canopus', 'data'),
+    State('session-id', 'data'),
 )
-def update_sunburst(tab_choice, selected_param, second_param, selected_locations,
-                    selected_samples2, threshold, filter_prob, filter_sirius,
-                    radio_choice, checkbox_levels, current_step_key, selected_compounds,
-                    metadata_dict, canopus_dict):
-
-    if not selected_locations or not metadata_dict or not canopus_dict or not current_step_key:
-        return no_update, False, go.Figure()
-
-    cleaned_data = cache_get(current_step_key)  # <-- fetch from cache
-    if cleaned_data is None:
-        return no_update, False, go.Figure()
-
-    cleaned_data = convert_commas_to_floats(cleaned_data)
-    if not cleaned_data.empty and cleaned_data.shape[1] > 0:
-        cleaned_data.set_index(cleaned_data.columns[0], inplace=True)
-    else:
-        return no_update, False, go.Figure()
+def update_selection(selected_param, second_param, selected_locations, selected_samples2,
+                     current_step_key, selected_compounds, target_mz, ppm, rt_min, rt_max,
+                     metadata_key, canopus_key, session_id):
+    # Only collects the parameters: the work happens once, in selection_context
+    if not selected_locations or not metadata_key or not canopus_key or not current_step_key:
+        return None
 
     if selected_compounds:
         if not isinstance(selected_compounds, list):
@@ -1669,44 +3215,65 @@ def update_sunburst(tab_choice, selected_param, second_param, selected_locations
     else:
         selected_compounds = None
 
-    metadata = pd.DataFrame(metadata_dict)
-    metadata.set_index(metadata.columns[0], inplace=True)
-
-    ft_sirius_NPC = pd.DataFrame(canopus_dict)
-    ft_sirius_NPC = convert_commas_to_floats(ft_sirius_NPC)
-    ft_sirius_NPC.set_index(ft_sirius_NPC.columns[0], inplace=True)
+    if not isinstance(selected_locations, list):
+        selected_locations = [selected_locations]
 
-    cleaned_data.index.name = 'filename'
-    metadata.index.name = 'filename'
-    ft_sirius_NPC.index.name = 'compound_name'
-    node_color_map = generate_node_level_color_map(ft_sirius_NPC)
-    
     if second_param and selected_samples2:
         if not isinstance(selected_samples2, list):
             selected_samples2 = [selected_samples2]
-        metadata = metadata[metadata[second_param].isin(selected_samples2)]
-
-    filtered_df = filter_merged_dataset(
-        cleaned_data=cleaned_data,
-        metadata=metadata.reset_index(),
-        ft_sirius=ft_sirius_NPC.reset_index(),
-        attribute_name=selected_param,
-        sample_locations=selected_locations,
-        threshold=threshold,
-        filter_class=None,
-        filter_prob=filter_prob,
-        filter_sirius=filter_sirius,
-        selected_compounds=selected_compounds 
-    )
+    else:
+        second_param, selected_samples2 = None, None
+
+    selection = {
+        'stage': current_step_key, 'metadata': metadata_key, 'canopus': canopus_key,
+        'session': session_id, 'param': selected_param, 'locations': selected_locations,
+        'second_param': second_param, 'samples2': selected_samples2,
+        'compounds': selected_compounds, 'target_mz': target_mz, 'ppm': ppm,
+        'rt_min': rt_min, 'rt_max': rt_max,
+    }
+    selection['key'] = content_hash(*selection.values())
+    return selection
+
+
+@callback(
+    Output("data-summary-toast", "children"),
+    Output("data-summary-toast", "is_open"),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+)
+def update_summary(selection, threshold, filter_prob, filter_sirius):
+    if not selection:
+        return no_update, False
+    with latest_request(selection['session'], 'summary'):
+        context = selection_context(selection)
+        if context is None:
+            return no_update, False
+        check_superseded()
+
+        filtered_df = filter_merged_dataset(
+            tables=context.tables,
+            ft_sirius=context.ft_sirius,
+            sample_locations=selection['locations'],
+            threshold=threshold,
+            filter_class=None,
+            filter_prob=filter_prob,
+            filter_sirius=filter_sirius,
+            selected_features=context.selected_features
+        )
+        check_superseded()
+
+    if filtered_df.shape[1] == 0:  # no feature matches the selected compounds
+        return no_update, False
 
     n_features = filtered_df.shape[0] + 1
-    n_samples = filtered_df.shape[1] 
+    # Selected samples present in the stage (filtered_df has one row per feature)
+    n_samples = len(pd.Index(context.stage.samples).intersection(context.sample_rows))
     n_pathways = filtered_df['NPC#pathway'].nunique()
     n_superclasses = filtered_df['NPC#superclass'].nunique()
     n_classes = filtered_df['NPC#class'].nunique()
 
-    filtered_df.index.name = 'filename'
-    
     summary = dbc.Row([
         dbc.Col([
             html.P(f"Retained features: {n_features}", className="mb-1"),
@@ -1718,149 +3285,240 @@ def update_sunburst(tab_choice, selected_param, second_param, selected_locations
             html.P(f"Retained pathways: {n_pathways}", className="mb-1"),
         ], width=7),
     ])
+    return summary, True
 
-    if not isinstance(selected_locations, list):
-        selected_locations = [selected_locations]
-
-    # your plot branch stays the same...
-    # (sunburst / barplot / PCA / line_plot / RT_mz / rf)
-    # just keep passing the DataFrames as you already do
 
-    # ...
-    # return summary, True, fig
-
-    if tab_choice == 'sunburst':
+@callback(
+    Output('graph-sunburst', 'figure'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    Input('radio-mode-store', 'data'),
+)
+def update_sunburst(tab_choice, selection, threshold, filter_prob, filter_sirius, radio_choice):
+    def plot(context):
         if radio_choice == 'Intensity':
-         
-            fig = process_and_plot_intensity_NPC(
-                cleaned_data=cleaned_data,
-                metadata=metadata.reset_index(),
-                ft_sirius=ft_sirius_NPC.reset_index(),
-                attribute_name=selected_param,
-                sample_locations= selected_locations,
+            return process_and_plot_intensity_NPC(
+                tables=context.tables,
+                ft_sirius=context.ft_sirius,
+                sample_locations=selection['locations'],
                 threshold=threshold,
-                node_color_map=node_color_map,
+                node_color_map=context.node_color_map,
                 filter_class=None,  # You can later wire this up from another input
                 filter_prob=filter_prob,
                 filter_sirius=filter_sirius,
-                selected_compounds = selected_compounds,
+                selected_features=context.selected_features,
             )
         elif radio_choice == 'Count':
-            
-            fig = process_and_plot_NPC_count(
-                cleaned_data=cleaned_data,
-                metadata=metadata.reset_index(),
-                ft_sirius=ft_sirius_NPC.reset_index(),
-                attribute_name=selected_param,
-                sample_locations=selected_locations,
+            return process_and_plot_NPC_count(
+                tables=context.tables,
+                ft_sirius=context.ft_sirius,
+                sample_locations=selection['locations'],
                 threshold=threshold,
-                node_color_map=node_color_map,
+                node_color_map=context.node_color_map,
                 filter_class=None,  # You can later wire this up from another input
                 filter_prob=filter_prob,
                 filter_sirius=filter_sirius,
-                selected_compounds = selected_compounds,
+                selected_features=context.selected_features,
             )
+        return go.Figure()
 
-        else:
-            fig = go.Figure()
-        
-    elif tab_choice == 'barplot':
-        fig = process_and_plot_barplot_NPC(
-            cleaned_data=cleaned_data,
-            metadata=metadata.reset_index(),
-            ft_sirius=ft_sirius_NPC.reset_index(),
-            attribute_name=selected_param,
-            sample_locations=selected_locations,
+    return tab_figure('sunburst', tab_choice, selection,
+                      (threshold, filter_prob, filter_sirius, radio_choice), plot)
+
+
+@callback(
+    Output('graph-barplot', 'figure'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    Input('radio-mode-store', 'data'),
+    Input('checkbox-levels', 'value'),
+)
+def update_barplot(tab_choice, selection, threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels):
+    def plot(context):
+        return process_and_plot_barplot_NPC(
+            tables=context.tables,
+            ft_sirius=context.ft_sirius,
+            sample_locations=selection['locations'],
             threshold=threshold,
-            node_color_map=node_color_map,
+            node_color_map=context.node_color_map,
             filter_class=None,
             filter_prob=filter_prob,
             filter_sirius=filter_sirius,
-            group_cols = checkbox_levels,
-            type_plot = radio_choice,
-            selected_compounds = selected_compounds,
+            group_cols=checkbox_levels,
+            type_plot=radio_choice,
+            selected_features=context.selected_features,
         )
-        
-    elif tab_choice == 'PCA':
-        fig = process_and_plot_pca(
+
+    return tab_figure('barplot', tab_choice, selection,
+                      (threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels), plot)
+
+
+@callback(
+    Output('store-job-PCA', 'data'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    State('store-job-PCA', 'data'),
+)
+def queue_pca(tab_choice, selection, threshold, filter_prob, filter_sirius, queued):
+    return tab_job('PCA', tab_choice, queued, selection, threshold, filter_prob, filter_sirius)
+
+
+@callback(
+    Output('graph-PCA', 'figure'),
+    Input('store-job-PCA', 'data'),
+    prevent_initial_call=True,
+    **job_options('PCA'),
+)
+def update_pca(set_progress, job):
+    selection = job['selection']
+    threshold, filter_prob, filter_sirius = job['settings']
+
+    def plot(context):
+        cleaned_data = sample_data(context, context.feature_cols)
+        if cleaned_data.empty or cleaned_data.shape[1] == 0:
+            return go.Figure()
+        return process_and_plot_pca(
             cleaned_data=cleaned_data,
-            metadata=metadata.reset_index(),
-            ft_sirius=ft_sirius_NPC.reset_index(),
-            attribute_name=selected_param,
-            sample_locations=selected_locations,
+            metadata=context.sample_metadata.reset_index(),
+            ft_sirius=context.ft_sirius,
+            attribute_name=selection['param'],
+            sample_locations=selection['locations'],
             threshold=threshold,
             filter_class=None,
             filter_prob=filter_prob,
             filter_sirius=filter_sirius, 
-            selected_compounds = selected_compounds,
-        )   
-        
-    elif tab_choice == 'line_plot':
-        fig = process_and_plot_lineplot_NPC(
-            cleaned_data=cleaned_data,
-            metadata=metadata.reset_index(),
-            ft_sirius=ft_sirius_NPC.reset_index(),
-            attribute_name=selected_param,
-            sample_locations=selected_locations,
+            selected_features=context.selected_features,
+        )
+
+    with job_progress(set_progress):
+        return build_figure('PCA', selection, job['settings'], plot, shared=True)
+
+
+@callback(
+    Output('graph-line_plot', 'figure'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    Input('radio-mode-store', 'data'),
+    Input('checkbox-levels', 'value'),
+)
+def update_lineplot(tab_choice, selection, threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels):
+    def plot(context):
+        return process_and_plot_lineplot_NPC(
+            tables=context.tables,
+            ft_sirius=context.ft_sirius,
+            sample_locations=selection['locations'],
             threshold=threshold,
-            node_color_map=node_color_map,
+            node_color_map=context.node_color_map,
             filter_class=None,
             filter_prob=filter_prob,
             filter_sirius=filter_sirius,
-            group_cols = checkbox_levels,
-            type_plot = radio_choice,
-            selected_compounds = selected_compounds,               
+            group_cols=checkbox_levels,
+            type_plot=radio_choice,
+            selected_features=context.selected_features,
         )
-    elif tab_choice == 'RT_mz':
-        fig = scatter_rt_mz(
-            cleaned_data=cleaned_data,
-            metadata=metadata.reset_index(),
-            ft_sirius=ft_sirius_NPC.reset_index(),
-            attribute_name=selected_param,
-            sample_locations=selected_locations,
+
+    return tab_figure('line_plot', tab_choice, selection,
+                      (threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels), plot)
+
+
+@callback(
+    Output('graph-RT_mz', 'figure'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    Input('checkbox-levels', 'value'),
+    Input('graph-RT_mz', 'relayoutData'),  # zoom, re-bins the map
+)
+def update_rt_mz_map(tab_choice, selection, threshold, filter_prob, filter_sirius, checkbox_levels, relayout):
+    # Only zooms re-bin the map (other relayouts, e.g. autosize, change nothing)
+    if ctx.triggered_id == 'graph-RT_mz':
+        zoomed = any(key.startswith(('xaxis.range', 'yaxis.range', 'xaxis.autorange', 'yaxis.autorange'))
+                     for key in (relayout or {}))
+        if not zoomed:
+            return no_update
+    else:
+        relayout = None
+
+    def plot(context):
+        # None when all features are already drawn: the browser zooms on its own
+        return scatter_rt_mz(
+            tables=context.tables,
+            ft_sirius=context.ft_sirius,
+            sample_locations=selection['locations'],
             threshold=threshold,
-            node_color_map=node_color_map,
+            node_color_map=context.node_color_map,
             filter_class=None,
             filter_prob=filter_prob,
             filter_sirius=filter_sirius,
-            group_cols = checkbox_levels,
-            type_plot = radio_choice,
-            selected_compounds = selected_compounds,
+            group_cols=checkbox_levels,
+            selected_features=context.selected_features,
+            relayout=relayout,
         )
 
-    
-    elif tab_choice == "rf":
-        fig = process_and_plot_rf(
+    view = (view_range(relayout, 'xaxis'), view_range(relayout, 'yaxis')) if relayout else None
+    return tab_figure('RT_mz', tab_choice, selection,
+                      (threshold, filter_prob, filter_sirius, checkbox_levels, view), plot)
+
+
+@callback(
+    Output('store-job-rf', 'data'),
+    Input('tabs-final-plot', 'active_tab'),
+    Input('store-selection', 'data'),
+    Input('threshold-slider', 'value'),
+    Input('probability-slider', 'value'),
+    Input('sirius-slider', 'value'),
+    Input('radio-mode-store', 'data'),
+    Input('checkbox-levels', 'value'),
+    State('store-job-rf', 'data'),
+)
+def queue_rf(tab_choice, selection, threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels, queued):
+    return tab_job('rf', tab_choice, queued, selection,
+                   threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels)
+
+
+@callback(
+    Output('graph-rf', 'figure'),
+    Input('store-job-rf', 'data'),
+    prevent_initial_call=True,
+    **job_options('rf'),
+)
+def update_rf(set_progress, job):
+    selection = job['selection']
+    threshold, filter_prob, filter_sirius, radio_choice, checkbox_levels = job['settings']
+
+    def plot(context):
+        cleaned_data = sample_data(context)
+        if cleaned_data.empty or cleaned_data.shape[1] == 0:
+            return go.Figure()
+        return process_and_plot_rf(
             cleaned_data=cleaned_data,
-            metadata=metadata,
-            ft_sirius=ft_sirius_NPC,
-            group_col=selected_param,
-            sample_locations=selected_locations,
+            metadata=context.sample_metadata,
+            ft_sirius=context.ft_sirius,
+            group_col=selection['param'],
+            sample_locations=selection['locations'],
             threshold=threshold,
             filter_class=checkbox_levels,
             filter_prob=filter_prob,
             filter_sirius=filter_sirius,
             type_plot=radio_choice
         )
-        return summary, True, fig
-
-         
-    else:
-        fig = go.Figure()
-        
-    return summary, True, fig
-
-
-@callback(
-    Output("loading-display-output", "children"),
-    Input("load-files-button", "n_clicks"),
-)
-def load_output(n):
-    if n:
-        time.sleep(2)
-        return f"Data updated {n} times."
-    return no_update
 
+    with job_progress(set_progress):
+        return build_figure('rf', selection, job['settings'], plot, shared=True)
 
 
 @callback(
@@ -1892,16 +3550,16 @@ def toggle_radio_style(n_int, n_count):
     State('information-dropdown', 'value'),
     prevent_initial_call=True
 )
-def update_information_dropdown(selected_param, n_clicks, metadata_dic, current_selection):
-    if metadata_dic is None:
+def update_information_dropdown(selected_param, n_clicks, metadata_key, current_selection):
+    if metadata_key is None:
         return [], None 
-    
-    metadata = pd.DataFrame(metadata_dic)
 
-    if selected_param is None or selected_param not in metadata.columns:
+    # Levels from the metadata bitmap index, no read of the metadata stage
+    samples = metadata_index(metadata_key)
+    if selected_param is None or samples is None or selected_param not in samples.levels:
         return [], None
 
-    unique_vals = metadata[selected_param].dropna().unique()
+    unique_vals = samples.levels[selected_param].tolist()
     options = [{"label": val, "value": val} for val in unique_vals]
     all_values = list(unique_vals)
 
@@ -1931,16 +3589,16 @@ def update_information_dropdown(selected_param, n_clicks, metadata_dic, current_
     State('information-dropdown2', 'value'),
     prevent_initial_call=True
 )
-def update_information_dropdown(selected_param, n_clicks, metadata_dic, current_selection):
-    if metadata_dic is None:
+def update_information_dropdown(selected_param, n_clicks, metadata_key, current_selection):
+    if metadata_key is None:
         return [], None 
-    
-    metadata = pd.DataFrame(metadata_dic)
 
-    if selected_param is None or selected_param not in metadata.columns:
+    # Levels from the metadata bitmap index, no read of the metadata stage
+    samples = metadata_index(metadata_key)
+    if selected_param is None or samples is None or selected_param not in samples.levels:
         return [], None
 
-    unique_vals = metadata[selected_param].dropna().unique()
+    unique_vals = samples.levels[selected_param].tolist()
     options = [{"label": val, "value": val} for val in unique_vals]
     all_values = list(unique_vals)
 
@@ -1964,12 +3622,16 @@ def update_information_dropdown(selected_param, n_clicks, metadata_dic, current_
 
 @callback(
     Output('file-status-drop', 'children'),
-    Input('upload-peak-areas', 'filename'),
-    Input('upload-metadata', 'filename'),
-    Input('upload-canopus', 'filename'),
-    Input('upload-structure','filename'),
+    Input('store-upload-peak-areas', 'data'),
+    Input('store-upload-metadata', 'data'),
+    Input('store-upload-canopus', 'data'),
+    Input('store-upload-structure', 'data'),
 )
-def show_uploaded_filenames(peak_name, meta_name, canopus_name,structure_name):
+def show_uploaded_filenames(peak_upload, meta_upload, canopus_upload, structure_upload):
+    peak_name, meta_name, canopus_name, structure_name = [
+        upload.get('filename') if upload else None
+        for upload in (peak_upload, meta_upload, canopus_upload, structure_upload)
+    ]
     messages = []
 
     if peak_name:
@@ -2055,20 +3717,24 @@ import pandas as pd
     State('store-metadata', 'data'),
     State('store-canopus', 'data'),
 )
-def update_data_preview(tab_selected, current_step_key, meta_data, cano_data):
+def update_data_preview(tab_selected, current_step_key, metadata_key, canopus_key):
     if tab_selected == 'peak':
-        df = cache_get(current_step_key)
-        if df is None:
+        stage = matrix_get(current_step_key)
+        if stage is None:
             return [], []
-        df = df.head(10)
+        df = matrix_frame(stage, rows=stage.samples[:10])
+        df.columns = stage_feature_labels(canopus_key, df.columns)
+        df = df.reset_index()
     elif tab_selected == 'meta':
-        if not meta_data:
+        df = cache_get(metadata_key)
+        if df is None:
             return [], []
-        df = pd.DataFrame(meta_data).head(10)
+        df = df.head(10)
     elif tab_selected == 'cano':
-        if not cano_data:
+        df = cache_get(canopus_key)
+        if df is None:
             return [], []
-        df = pd.DataFrame(cano_data).head(10)
+        df = df.head(10)
     else:
         return [], []
 
@@ -2076,31 +3742,27 @@ def update_data_preview(tab_selected, current_step_key, meta_data, cano_data):
     return df.to_dict('records'), columns
 
 
-# Enable 'Impute' after 'Blank Subtraction'
+# Enable 'Impute' once a blanked stage exists ('Blanked' or 'All steps')
 @app.callback(
     Output('btn-imputed', 'disabled'),
-    Input('btn-blanked', 'n_clicks'),
+    Input('store-blanked', 'data'),
 )
-def enable_impute(n_clicks_blank):
-    if n_clicks_blank is None:
-        return True  # Keep the button disabled
-    return n_clicks_blank <= 0  # Disable if not clicked yet
+def enable_impute(blanked_key):
+    return not blanked_key  # Disabled until there is something to impute
 
 
-# Enable 'Normalization' after 'Impute'
+# Enable 'Normalization' and 'Scaling' once an imputed stage exists
 @app.callback(
     Output('btn-normalized', 'disabled'),
     Output('btn-scaled', 'disabled'),
-    Input('btn-imputed', 'n_clicks'),
+    Input('store-imputed', 'data'),
 )
-def enable_impute(n_clicks_blank):
-    if n_clicks_blank is None:
-        return True, True  # Keep the button disabled
-    return n_clicks_blank <= 0,  n_clicks_blank <= 0 # Disable if not clicked yet
+def enable_impute(imputed_key):
+    return not imputed_key, not imputed_key
 
 @app.callback(
     Output("upload-status", "children"),
-    Output('store-peak-areas', 'data'),   # now a KEY like "raw"
+    Output('store-peak-areas', 'data'),   # now a KEY like "shared:raw:<hash>"
     Output('store-canopus', 'data'),
     Output('store-metadata', 'data'),
     Output('parameter-dropdown', 'options'),
@@ -2108,187 +3770,210 @@ def enable_impute(n_clicks_blank):
     Output('parameter-dropdown', 'value'),
     Output('parameter-dropdown2', 'value'),
     Input("load-files-button", "n_clicks"),
-    State("upload-peak-areas", "contents"),
-    State("upload-metadata", "contents"),
-    State("upload-canopus", "contents"),
-    State("upload-structure", "contents"),
+    State("store-upload-peak-areas", "data"),
+    State("store-upload-metadata", "data"),
+    State("store-upload-canopus", "data"),
+    State("store-upload-structure", "data"),
     State("is-raw-checkbox", "value"),
     State("sample-pattern-input", "value"),
     State("checkbox-trim", "value"),
-    prevent_initial_call=True
+    prevent_initial_call=True,
+    **job_options('load', (Output('load-files-button', 'disabled'), True, False)),
 )
-def handle_file_upload(n_clicks, peak_contents, metadata_contents, canopus_contents, structure_contents,
+def handle_file_upload(set_progress, n_clicks, peak_upload, metadata_upload, canopus_upload, structure_upload,
                        is_raw, sample_pattern, checkbox_trim):
-    if not all([peak_contents, metadata_contents, canopus_contents]):
+    if not all([peak_upload, metadata_upload, canopus_upload]) or (is_raw and not structure_upload):
         return dbc.Alert("Please upload all required files.", color="warning"), None, None, None, [], [], None, None
 
     if not sample_pattern:
         return dbc.Alert("Please enter a sample name pattern.", color="danger"), None, None, None, [], [], None, None
 
-    if is_raw:
-        pattern = sample_pattern
-        is_trim = "check_trim" in checkbox_trim
-        df1 = parse_contents(peak_contents, trim=is_trim)
-        df2 = parse_contents(canopus_contents)
-        df3 = parse_contents(metadata_contents)
-        df4 = parse_contents(structure_contents)
-
-        # Your pipeline
-        df1_p, df2_p = processing_raw_files(df1, df3, df2, df4, pattern)
-
-        # Downcast
+    is_trim = "check_trim" in (checkbox_trim or [])
+
+    # Same files + same settings -> same keys, so a re-upload is served from cache, for
+    # every session: the stages are shared
+    fingerprint = (peak_upload['sha1'], metadata_upload['sha1'], canopus_upload['sha1'],
+                   structure_upload['sha1'] if is_raw else None,
+                   bool(is_raw), sample_pattern if is_raw else None, is_trim if is_raw else None,
+                   STAGE_FORMAT)
+    raw_key = make_stage_key(None, 'raw', *fingerprint)
+    canopus_key = make_stage_key(None, 'canopus', *fingerprint)
+    metadata_key = make_stage_key(None, 'metadata', *fingerprint)
+    sweep_stages()
+
+    # Only the metadata column names are needed on a cache hit
+    df3 = pd.DataFrame(columns=cache_columns(metadata_key))
+    from_cache = (matrix_has(raw_key) and cache_has(canopus_key) and cache_has(metadata_key)
+                  and os.path.exists(stage_path(canopus_key, ".colors.json")))
+
+    if from_cache:
+        for key, ext in ((raw_key, ".f32.npy"), (canopus_key, ".parquet"), (metadata_key, ".parquet")):
+            touch_stage(key, ext)
+    else:
+        # Upload files are deleted once loaded: new settings need the files again
+        if not uploads_present(peak_upload, metadata_upload, canopus_upload, structure_upload if is_raw else None):
+            return (dbc.Alert("Uploaded files are no longer on the server, please upload them again.", color="warning"),
+                    None, None, None, [], [], None, None)
+        set_progress((0, "Reading files"))
+        if is_raw:
+            pattern = sample_pattern
+            df1 = parse_upload(peak_upload, trim=is_trim)
+            df2 = parse_upload(canopus_upload)
+            df3 = parse_upload(metadata_upload)
+            df4 = parse_upload(structure_upload)
+
+            # Your pipeline
+            set_progress((33, "Processing raw files"))
+            df1_p, df2_p = processing_raw_files(df1, df3, df2, df4, pattern)
+        else:
+            # Processed files are keyed by their "X..." labels: switch to feature ids
+            try:
+                df1_p, df2_p = register_features(convert_commas_to_floats(parse_upload(peak_upload)),
+                                                 parse_upload(canopus_upload))
+            except ValueError as e:
+                return dbc.Alert(str(e), color="danger"), None, None, None, [], [], None, None
+            df3 = parse_upload(metadata_upload)
+
+        # Downcast (annotation scores are cast by prepare_annotations; registry fields keep their types)
+        set_progress((66, "Writing stages"))
         df1_p = downcast_numeric(df1_p)
-        df2_p = downcast_numeric(df2_p)
+        df2_p = prepare_annotations(df2_p)
         df3   = downcast_numeric(df3)
 
-        # Put heavy frames in cache
-        raw_key = cache_put(df1_p, "raw")
+        # Put heavy frames in cache; the node colors are stored with the annotations
+        matrix_put(df1_p, raw_key)
+        annotations_put(df2_p, canopus_key, generate_node_level_color_map(df2_p))
+        cache_put(df3, metadata_key)
 
-        # Keep metadata/canopus in Store
-        df3_dict = df3.to_dict("records")
-        cano_dict = df2_p.to_dict("records")
+    # Their content now lives in the stages
+    remove_uploads(peak_upload, metadata_upload, canopus_upload, structure_upload if is_raw else None)
 
-        options = [{"label": col, "value": col} for col in df3.columns]
-        return (
-            dbc.Alert("Raw files uploaded and processed.", color="info"),
-            raw_key,                # store-peak-areas holds "raw"
-            cano_dict,
-            df3_dict,
-            options, options, df3.columns[1], df3.columns[1]
-        )
+    if is_raw:
+        message = dbc.Alert("Raw files uploaded and processed.", color="info")
     else:
-        df1 = parse_contents(peak_contents)
-        df2 = parse_contents(canopus_contents)
-        df3 = parse_contents(metadata_contents)
-
-        # Downcast
-        df1 = downcast_numeric(df1)
-        df2 = downcast_numeric(df2)
-        df3 = downcast_numeric(df3)
-
-        # Cache raw
-        raw_key = cache_put(df1, "raw")
-
-        options = [{"label": col, "value": col} for col in df3.columns]
-        return (
-            dbc.Alert("Processed files uploaded.", color="success"),
-            raw_key,                 # store-peak-areas holds "raw"
-            df2.to_dict("records"),
-            df3.to_dict("records"),
-            options, options, df3.columns[1], df3.columns[1]
-        )
+        message = dbc.Alert("Processed files uploaded.", color="success")
+    if from_cache:
+        message = dbc.Alert("Files unchanged, loaded from cache.", color="secondary")
+
+    # Stores only hold the stage keys; the tables stay on the server
+    options = [{"label": col, "value": col} for col in df3.columns]
+    return (
+        message,
+        raw_key,                # store-peak-areas holds the raw stage key
+        canopus_key,
+        metadata_key,
+        options, options, df3.columns[1], df3.columns[1]
+    )
 
 
-@app.callback(
-    Output('store-blanked', 'data'),                 # now "blanked"
-    Output('upload-status-blank', 'children'),
-    Input('btn-blanked', 'n_clicks'),
-    State('store-peak-areas', 'data'),               # "raw"
-    State('store-metadata', 'data'),
-    prevent_initial_call=True
-)
-def apply_blank(n_clicks, raw_key, meta_data):
-    if not raw_key or not meta_data:
-        return no_update, dbc.Alert("Missing input for blank subtraction.", color="danger")
+# Stages computed by each processing button
+STAGE_BUTTONS = {
+    'btn-blanked': ('blanked',),
+    'btn-imputed': ('imputed',),
+    'btn-normalized': ('normalized',),
+    'btn-scaled': ('scaled',),
+    'btn-run-all': PREPROCESSING_STAGES,
+}
+STAGE_STATUS_LABELS = {
+    'blanked': "Blank subtraction",
+    'imputed': "Imputation",
+    'normalized': "Normalization",
+    'scaled': "Scaling",
+}
 
-    ft = cache_get(raw_key)
-    if ft is None:
-        return no_update, dbc.Alert("Cached RAW data not found.", color="danger")
 
-    md = pd.DataFrame(meta_data)
-    ft = convert_commas_to_floats(ft).set_index(ft.columns[0])
-    md = convert_commas_to_floats(md).set_index(md.columns[0])
-    try:
-        cleaned_df, _ = blank_processing(ft, md)
-        cleaned_df = downcast_numeric(cleaned_df)
-        blanked_key = cache_put(cleaned_df, "blanked")
-        return blanked_key, dbc.Alert("Blank subtraction complete.", color="success")
-    except Exception as e:
-        return no_update, dbc.Alert(f"Blank subtraction failed: {e}", color="danger")
+def pipeline_stores(raw_key, blank_cutoff, strategy):
+    """Stage store values: the key of each stage that exists for these parameters, else None."""
+    keys = pipeline_keys(raw_key, {'blank_cutoff': blank_cutoff, 'imputation_strategy': strategy})
+    return tuple(keys[stage] if matrix_has(keys[stage]) else None for stage in PREPROCESSING_STAGES)
 
 
 @app.callback(
-    Output('store-imputed', 'data'),                 # "imputed"
+    Output('store-blanked', 'data'),                 # "shared:blanked:<hash>"
+    Output('store-imputed', 'data'),                 # "shared:imputed:<hash>"
+    Output('store-normalized', 'data'),              # "shared:normalized:<hash>"
+    Output('store-scaled', 'data'),                  # "shared:scaled:<hash>"
+    Output('upload-status-blank', 'children'),
     Output('upload-status-imputation', 'children'),
-    Input('btn-imputed', 'n_clicks'),
-    State('store-blanked', 'data'),                  # "blanked"
+    Output('upload-status-normalization', 'children'),
+    Output('upload-status-scaling', 'children'),
+    Input('store-peak-areas', 'data'),               # raw key
+    Input('blank-slider', 'value'),
+    Input('imputation-strategy', 'value'),
     prevent_initial_call=True
 )
-def apply_imputation(n_clicks, blanked_key):
-    if not blanked_key:
-        return no_update, dbc.Alert("No data to impute.", color="danger")
-
-    df = cache_get(blanked_key)
-    if df is None:
-        return no_update, dbc.Alert("Cached BLANKED data not found.", color="danger")
-
-    try:
-        imputed_df = imputation(df)
-        imputed_df = downcast_numeric(imputed_df)
-        imputed_key = cache_put(imputed_df, "imputed")
-        return imputed_key, dbc.Alert("Imputation complete.", color="success")
-    except Exception as e:
-        return no_update, dbc.Alert(f"Imputation failed: {e}", color="danger")
+def update_pipeline_keys(raw_key, blank_cutoff, strategy):
+    # A new raw key or parameter only re-keys the stages, so the stores point at cached
+    # results or are cleared when the stage has to be recomputed (see run_pipeline)
+    if not raw_key:
+        return (None,) * len(PREPROCESSING_STAGES) + (no_update,) * len(PREPROCESSING_STAGES)
+    stores = pipeline_stores(raw_key, blank_cutoff, strategy)
+    # Clear the messages of the stages that are no longer up to date
+    return stores + tuple(no_update if key else None for key in stores)
 
 
 @app.callback(
-    Output('store-normalized', 'data'),              # "normalized"
-    Output('upload-status-normalization', 'children'),
+    Output('store-blanked', 'data', allow_duplicate=True),
+    Output('store-imputed', 'data', allow_duplicate=True),
+    Output('store-normalized', 'data', allow_duplicate=True),
+    Output('store-scaled', 'data', allow_duplicate=True),
+    Output('upload-status-blank', 'children', allow_duplicate=True),
+    Output('upload-status-imputation', 'children', allow_duplicate=True),
+    Output('upload-status-normalization', 'children', allow_duplicate=True),
+    Output('upload-status-scaling', 'children', allow_duplicate=True),
+    Input('btn-blanked', 'n_clicks'),
+    Input('btn-imputed', 'n_clicks'),
     Input('btn-normalized', 'n_clicks'),
-    State('store-imputed', 'data'),                  # "imputed"
-    prevent_initial_call=True
+    Input('btn-scaled', 'n_clicks'),
+    Input('btn-run-all', 'n_clicks'),
+    State('store-peak-areas', 'data'),
+    State('blank-slider', 'value'),
+    State('imputation-strategy', 'value'),
+    State('store-metadata', 'data'),
+    prevent_initial_call=True,
+    **job_options('pipeline'),
 )
-def apply_normalization(n_clicks, imputed_key):
-    if not imputed_key:
-        return no_update, dbc.Alert("No data to normalize.", color="danger")
-
-    df = cache_get(imputed_key)
-    if df is None:
-        return no_update, dbc.Alert("Cached IMPUTED data not found.", color="danger")
-
+def run_pipeline(set_progress, n_blank, n_impute, n_normalize, n_scale, n_all,
+                 raw_key, blank_cutoff, strategy, metadata_key):
+    # Buttons compute their stage (and any missing stage above it), as a background job
+    status = dict.fromkeys(PREPROCESSING_STAGES, no_update)
+    targets = STAGE_BUTTONS.get(ctx.triggered_id, ())
+    if not raw_key:
+        for stage in targets:
+            status[stage] = dbc.Alert(f"Missing input for {STAGE_STATUS_LABELS[stage].lower()}.", color="danger")
+        return (None,) * len(PREPROCESSING_STAGES) + tuple(status.values())
+
+    params = {'blank_cutoff': blank_cutoff, 'imputation_strategy': strategy}
+    sweep_stages()
+    md = cache_get(metadata_key)
+    if md is not None:
+        md = convert_commas_to_floats(md).set_index(md.columns[0])
     try:
-        normalized_df = normalization(df)
-        normalized_df = downcast_numeric(normalized_df)
-        normalized_key = cache_put(normalized_df, "normalized")
-        return normalized_key, dbc.Alert("Normalization complete.", color="success")
+        with job_progress(set_progress):
+            _, computed = materialize_stages(raw_key, targets, params, md)
+        for stage in targets:
+            cached = "" if stage in computed else " (cached)"
+            status[stage] = dbc.Alert(f"{STAGE_STATUS_LABELS[stage]} complete{cached}.", color="success")
     except Exception as e:
-        return no_update, dbc.Alert(f"Normalization failed: {e}", color="danger")
-
-
-@app.callback(
-    Output('store-scaled', 'data'),                  # "scaled"
-    Output('upload-status-scaling', 'children'),
-    Input('btn-scaled', 'n_clicks'),
-    State('store-imputed', 'data'),                  # "imputed" (your pipeline uses imputed -> scaled)
-    prevent_initial_call=True
-)
-def apply_scaling(n_clicks, imputed_key):
-    if not imputed_key:
-        return no_update, dbc.Alert("No data to scale.", color="danger")
+        for stage in targets:
+            status[stage] = dbc.Alert(f"{STAGE_STATUS_LABELS[stage]} failed: {e}", color="danger")
 
-    df = cache_get(imputed_key)
-    if df is None:
-        return no_update, dbc.Alert("Cached IMPUTED data not found.", color="danger")
+    return pipeline_stores(raw_key, blank_cutoff, strategy) + tuple(status.values())
 
-    try:
-        scaled_df = scaling(df)
-        scaled_df = downcast_numeric(scaled_df)
-        scaled_key = cache_put(scaled_df, "scaled")
-        return scaled_key, dbc.Alert("Scaling complete.", color="success")
-    except Exception as e:
-        return no_update, dbc.Alert(f"Scaling failed: {e}", color="danger")
 
 @callback(
-    Output('store-current-step', 'data'),  # e.g. "blanked"
+    Output('store-current-step', 'data'),  # e.g. "shared:blanked:<hash>"
     Input('data-version-dropdown', 'value'),
-    State('store-peak-areas', 'data'),
-    State('store-blanked', 'data'),
-    State('store-imputed', 'data'),
-    State('store-normalized', 'data'),
-    State('store-scaled', 'data'),
+    # Stage stores are inputs too: a recomputed or invalidated stage updates the view
+    Input('store-peak-areas', 'data'),
+    Input('store-blanked', 'data'),
+    Input('store-imputed', 'data'),
+    Input('store-normalized', 'data'),
+    Input('store-scaled', 'data'),
+    State('store-current-step', 'data'),
     prevent_initial_call=True
 )
-def update_current_step(selected_version, raw_key, blanked_key, imputed_key, normalized_key, scaled_key):
+def update_current_step(selected_version, raw_key, blanked_key, imputed_key, normalized_key, scaled_key, current_key):
     mapping = {
         'raw': raw_key,
         'blanked': blanked_key,
@@ -2296,31 +3981,28 @@ def update_current_step(selected_version, raw_key, blanked_key, imputed_key, nor
         'normalized': normalized_key,
         'scaled': scaled_key
     }
-    key = mapping.get(selected_version)
-    if key:
-        return key
-    elif raw_key:
-        return raw_key
-    else:
+    key = mapping.get(selected_version) or raw_key
+    if not key or key == current_key:
         return no_update
+    return key
 
 
 @callback(
     Output("download-dataframe-csv", "data"),
     Input("download-btn", "n_clicks"),
     State("store-current-step", "data"),
+    State('store-canopus', 'data'),
     prevent_initial_call=True,
 )
-def download_csv(n_clicks, current_step_key):
-    df = cache_get(current_step_key)
-    if df is None:
+def download_csv(n_clicks, current_step_key, canopus_key):
+    stage = matrix_get(current_step_key)
+    if stage is None:
         return no_update
 
-    df = convert_commas_to_floats(df)
-    if not df.empty and df.shape[1] > 0:
-        df.set_index(df.columns[0], inplace=True)
-    else:
+    df = matrix_frame(stage)
+    if df.empty or df.shape[1] == 0:
         return no_update 
+    df.columns = stage_feature_labels(canopus_key, df.columns)  # the exported file keeps the "X..." labels
 
     return dcc.send_data_frame(df.to_csv, 'data_processed.csv', index=True)
 
@@ -2328,24 +4010,32 @@ def download_csv(n_clicks, current_step_key):
 @callback(
     Output('store-compound-names', 'data'),
     Input("store-current-step", "data"),
+    State('store-canopus', 'data'),
     prevent_initial_call=True
 )
-def extract_compound_names(current_step_key):
-    if not current_step_key:
-        return []
+def extract_compound_names(current_step_key, canopus_key):
+    if not current_step_key or not canopus_key:
+        return None
 
-    df = cache_get(current_step_key)
-    if df is None or df.empty or df.shape[1] == 0:
-        return []
+    # Build the search index now, so the first keystroke does not pay for it; the
+    # browser only keeps the keys to find it (or rebuild it in another worker)
+    search_keys = {'stage': current_step_key, 'canopus': canopus_key}
+    if compound_search_index(search_keys) is None:
+        return None
+    return search_keys
 
-    df = df.copy()
-    df.set_index(df.columns[0], inplace=True)
 
-    compound_names = [
-        col.rsplit('_', 1)[-1].rsplit(';', 1)[0]
-        for col in df.columns
-    ]
-    return compound_names
+def compound_search_index(search_keys):
+    """Search index of the features of a stage, or None if the stage is gone."""
+    def build():
+        # Only the feature ids are needed from the matrix: read them from the sidecar
+        stage = matrix_get(search_keys['stage'])
+        registry = cache_get(search_keys['canopus'], columns=['name', 'pubchem', 'mz'])
+        if stage is None or registry is None:
+            return None
+        # Registry rows are in feature id order
+        return build_search_index(registry.iloc[stage.features])
+    return cached_index(('search', search_keys['stage'], search_keys['canopus']), build)
 
 
 
@@ -2357,26 +4047,25 @@ def extract_compound_names(current_step_key):
     State('store-compound-names', 'data'),
     prevent_initial_call=True
 )
-def update_information_dropdown(search_value, is_checked, compound_names):
+def update_information_dropdown(search_value, is_checked, search_keys):
     if not is_checked:
         return []
 
-    if not compound_names:
+    if not search_keys or not search_value:
         return []
 
-    if search_value:
-        filtered = [
-            name for name in compound_names
-            if search_value.lower() in name.lower()
-        ]
-    else:
-        filtered = []
-        #default_value = filtered[0] if filtered else None
-    # Limit to first 20 to keep UI light
-    filtered = filtered[:20]
-    
-    options = [{"label": name, "value": name} for name in filtered]
-    
+    index = compound_search_index(search_keys)
+    if index is None:
+        return []
+
+    # Limit to first 20 to keep UI light (ranked: exact, prefix, substring, fuzzy)
+    matches = search_compounds(index, search_value, limit=20)
+
+    # Show what matched when it is not the name itself (PubChem id, m/z)
+    options = [
+        {"label": name if key == name else f"{name} ({key})", "value": name}
+        for name, key in matches
+    ]
 
     return options
 
@@ -0,0 +1,142 @@
+/*
+ * Chunked, resumable uploads for the CANVAS upload zones.
+ *
+ * Every element with class "chunked-upload" acts as a drop zone / file picker.
+ * The selected file is streamed to the /upload/<id> routes of the Flask server in
+ * CHUNK_SIZE pieces instead of being base64-encoded into a dcc.Upload `contents`
+ * prop. When the file is complete, the dcc.Store named in the zone's data-store
+ * attribute receives {upload_id, filename, size, sha1}; callbacks only ever see
+ * that handle. Progress goes to the "<zone id>-progress" component.
+ */
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var MAX_RETRIES = 5;
+
+    function tabToken() {
+        var token = window.sessionStorage.getItem('canvas-upload-token');
+        if (!token) {
+            token = Math.random().toString(36).slice(2) + Date.now().toString(36);
+            window.sessionStorage.setItem('canvas-upload-token', token);
+        }
+        return token;
+    }
+
+    // Same file in the same tab -> same id, so an interrupted upload resumes
+    function uploadId(file) {
+        var text = [file.name, file.size, file.lastModified].join('|');
+        var hash = 0;
+        for (var i = 0; i < text.length; i++) {
+            hash = (hash * 31 + text.charCodeAt(i)) | 0;
+        }
+        return tabToken() + '-' + (hash >>> 0).toString(16) + '-' + file.size.toString(16);
+    }
+
+    function setProps(id, props) {
+        if (window.dash_clientside && window.dash_clientside.set_props) {
+            window.dash_clientside.set_props(id, props);
+        }
+    }
+
+    function sleep(ms) {
+        return new Promise(function (resolve) { setTimeout(resolve, ms); });
+    }
+
+    async function receivedBytes(id) {
+        var response = await fetch('/upload/' + id);
+        if (!response.ok) {
+            throw new Error('HTTP ' + response.status);
+        }
+        return (await response.json()).received;
+    }
+
+    async function sendFile(zone, file) {
+        var id = uploadId(file);
+        var progressId = zone.id + '-progress';
+        var offset = 0;
+        var retries = 0;
+
+        while (true) {
+            try {
+                if (retries > 0 || offset === 0) {
+                    // Ask the server where to continue (resume after reload/failure)
+                    offset = await receivedBytes(id);
+                }
+                while (offset < file.size) {
+                    var response = await fetch('/upload/' + id + '?offset=' + offset + '&size=' + file.size, {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/octet-stream'},
+                        body: file.slice(offset, offset + CHUNK_SIZE),
+                    });
+                    if (response.status >= 400 && response.status < 500 && response.status !== 409) {
+                        // Refused (size limits, too many uploads): retrying would not help
+                        var refused = await response.json().catch(function () { return {}; });
+                        setProps(progressId, {children: 'Upload failed: ' + (refused.error || 'HTTP ' + response.status)});
+                        return;
+                    }
+                    if (!response.ok && response.status !== 409) {
+                        throw new Error('HTTP ' + response.status);
+                    }
+                    // 409: server has a different offset, continue from there
+                    offset = (await response.json()).received;
+                    retries = 0;
+                    setProps(progressId, {children: Math.floor(100 * offset / file.size) + '%'});
+                }
+                var done = await fetch('/upload/' + id + '/complete', {method: 'POST'});
+                if (!done.ok) {
+                    throw new Error('HTTP ' + done.status);
+                }
+                var upload = await done.json();
+                upload.filename = file.name;
+                setProps(progressId, {children: ''});
+                setProps(zone.dataset.store, {data: upload});
+                return;
+            } catch (err) {
+                retries += 1;
+                if (retries > MAX_RETRIES) {
+                    setProps(progressId, {children: 'Upload failed: ' + err.message});
+                    return;
+                }
+                await sleep(500 * retries);
+            }
+        }
+    }
+
+    function zoneOf(target) {
+        return target && target.closest ? target.closest('.chunked-upload') : null;
+    }
+
+    document.addEventListener('click', function (event) {
+        var zone = zoneOf(event.target);
+        if (!zone) {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        if (zone.dataset.accept) {
+            input.accept = zone.dataset.accept;
+        }
+        input.addEventListener('change', function () {
+            if (input.files.length) {
+                sendFile(zone, input.files[0]);
+            }
+        });
+        input.click();
+    });
+
+    document.addEventListener('dragover', function (event) {
+        if (zoneOf(event.target)) {
+            event.preventDefault();
+        }
+    });
+
+    document.addEventListener('drop', function (event) {
+        var zone = zoneOf(event.target);
+        if (!zone) {
+            return;
+        }
+        event.preventDefault();
+        if (event.dataTransfer.files.length) {
+            sendFile(zone, event.dataTransfer.files[0]);
+        }
+    });
+})();
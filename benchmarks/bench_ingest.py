@@ -0,0 +1,71 @@
+"""
+Benchmark of the raw-file ingest step (processing_raw_files) versus feature count.
+
+Builds synthetic MSDIAL / SIRIUS / CANOPUS tables of increasing size and times the
+annotation join + name consolidation + transpose. Run from the repository root:
+
+    python benchmarks/bench_ingest.py
+    python benchmarks/bench_ingest.py --features 1000 10000 60000 --samples 200
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import processing_raw_files  # noqa: E402
+
+
+def synthetic_tables(n_features, n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, n_features + 1)
+    samples = [f"S_{i:04d}" for i in range(n_samples)]
+
+    peak_areas = pd.DataFrame({
+        'Alignment ID': ids,
+        'Average Rt(min)': rng.uniform(0.5, 20, n_features),
+        'Average Mz': rng.uniform(100, 1200, n_features),
+    })
+    intensities = rng.lognormal(10, 2, (n_features, n_samples)).round()
+    peak_areas = pd.concat([peak_areas, pd.DataFrame(intensities, columns=samples)], axis=1)
+
+    annotated = ids[rng.random(n_features) < 0.9]
+    structure = pd.DataFrame({
+        'mappingFeatureId': annotated,
+        'name': [f"Compound_{i}" for i in annotated],
+        'pubchemids': [f"CID{i}" for i in annotated],
+        'SiriusScoreNormalized': rng.random(len(annotated)),
+    })
+    canopus = pd.DataFrame({'mappingFeatureId': annotated})
+    for level, n_labels in [('pathway', 7), ('superclass', 70), ('class', 600)]:
+        canopus[f'NPC#{level}'] = rng.integers(0, n_labels, len(annotated)).astype(str)
+        canopus[f'NPC#{level} Probability'] = rng.random(len(annotated))
+    metadata = pd.DataFrame({'name_file': samples, 'Type': 'Sample'})
+    return peak_areas, metadata, canopus, structure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--features', type=int, nargs='+', default=[1000, 5000, 20000, 60000])
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'features':>10} {'samples':>8} {'best [s]':>10} {'us/feature':>11}")
+    for n_features in args.features:
+        peak_areas, metadata, canopus, structure = synthetic_tables(n_features, args.samples)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            ft_t, _ = processing_raw_files(peak_areas, metadata, canopus, structure, 'S_')
+            timings.append(time.perf_counter() - start)
+        assert ft_t.shape[0] == args.samples
+        best = min(timings)
+        print(f"{n_features:>10} {args.samples:>8} {best:>10.3f} {1e6 * best / n_features:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()